@@ -5,3 +5,5 @@ type VARCHAR(32) NOT NULL,
 value TEXT,
 seq INT NOT NULL DEFAULT 0
 );
+
+CREATE INDEX account_attr__account_seq ON account_attr(account, seq);
@@ -0,0 +1,206 @@
+# Benchmark ppxml2db tools: generate synthetic XML file (using gen_ppxml.py),
+# then import it into a database, export it back and check that the result
+# is identical to the input. Time and peak memory (RSS) of each phase is
+# recorded (min/median over --repeat runs), and can be saved as JSON to
+# compare with results for another commit (--compare).
+import sys
+import os
+import os.path
+import argparse
+import subprocess
+import time
+import json
+import platform
+import shlex
+import statistics
+import tempfile
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+# Tools are run from the top-level dir, as they expect schema files there.
+TOP_DIR = os.path.dirname(BENCH_DIR)
+
+SIZES = {
+    "tiny": ["--securities", "5", "--prices", "20", "--xacts", "50"],
+    "small": ["--securities", "20", "--prices", "200", "--xacts", "500"],
+    "medium": [
+        "--securities", "100", "--prices", "2000", "--xacts", "5000",
+        "--accounts", "5", "--portfolios", "4",
+    ],
+    "large": [
+        "--securities", "500", "--prices", "5000", "--xacts", "50000",
+        "--accounts", "10", "--portfolios", "8", "--taxonomy-depth", "5",
+    ],
+}
+
+
+# Run a command, returning (wall time in s, peak RSS in KiB).
+def run(cmd):
+    t = time.perf_counter()
+    p = subprocess.Popen(cmd, cwd=TOP_DIR, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(p.pid, 0)
+    t = time.perf_counter() - t
+    # Let Popen know the process has been reaped.
+    if os.WIFEXITED(status):
+        p.returncode = os.WEXITSTATUS(status)
+    else:
+        p.returncode = -os.WTERMSIG(status)
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return t, rusage.ru_maxrss
+
+
+# Compare files line by line, returning None if they're identical, or
+# number of first differing line.
+def compare(fname1, fname2):
+    with open(fname1, "rb") as f1, open(fname2, "rb") as f2:
+        lineno = 0
+        while True:
+            lineno += 1
+            l1 = f1.readline()
+            l2 = f2.readline()
+            if l1 != l2:
+                return lineno
+            if not l1:
+                return None
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=TOP_DIR,
+            stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench(args, workdir):
+    py = sys.executable
+    gen_opts = SIZES[args.size] + shlex.split(args.gen_opts)
+    xml = os.path.join(workdir, "bench.xml")
+    out_xml = os.path.join(workdir, "bench.out.xml")
+    if args.db is None:
+        db = os.path.join(workdir, "bench.db")
+    elif args.dbtype == "sqlite":
+        db = os.path.abspath(args.db)
+    else:
+        db = args.db
+    db_opts = ["--dbtype", args.dbtype]
+
+    print("Generating %s" % " ".join(gen_opts), file=sys.stderr)
+    run([py, os.path.join(BENCH_DIR, "gen_ppxml.py")] + gen_opts + [xml])
+
+    res = {
+        "rev": git_rev(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "size": args.size,
+        "gen_opts": gen_opts,
+        "import_opts": args.import_opts,
+        "export_opts": args.export_opts,
+        "dbtype": args.dbtype,
+        "xml_bytes": os.path.getsize(xml),
+        "roundtrip": None,
+        "phases": {},
+    }
+    measures = {"import": [], "export": [], "roundtrip": []}
+
+    for i in range(args.repeat):
+        print("Run %d/%d" % (i + 1, args.repeat), file=sys.stderr)
+        init_cmd = [py, "ppxml2db_init.py"] + db_opts
+        if args.dbtype == "sqlite":
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db + suffix):
+                    os.remove(db + suffix)
+        else:
+            init_cmd.append("--recreate")
+        if "--fast" in shlex.split(args.import_opts):
+            init_cmd.append("--fast")
+        run(init_cmd + [db])
+
+        measures["import"].append(run(
+            [py, "ppxml2db.py"] + db_opts + shlex.split(args.import_opts) + [xml, db]
+        ))
+        measures["export"].append(run(
+            [py, "db2ppxml.py"] + db_opts + shlex.split(args.export_opts) + [db, out_xml]
+        ))
+
+        t = time.perf_counter()
+        diff_line = compare(xml, out_xml)
+        measures["roundtrip"].append((time.perf_counter() - t, None))
+        if diff_line is not None:
+            res["roundtrip"] = "differs at line %d" % diff_line
+            print("Round-trip result %s differs from %s at line %d" % (out_xml, xml, diff_line), file=sys.stderr)
+            break
+        res["roundtrip"] = "ok"
+
+    for phase, runs in measures.items():
+        times = [t for t, _ in runs]
+        rss = [m for _, m in runs if m is not None]
+        res["phases"][phase] = {
+            "time": round(min(times), 3),
+            "time_median": round(statistics.median(times), 3),
+            "peak_rss_kb": max(rss) if rss else None,
+        }
+    return res
+
+
+def report(res, old=None, f=sys.stdout):
+    print("rev: %s, size: %s (%d bytes), round-trip: %s" % (
+        res["rev"], res["size"], res["xml_bytes"], res["roundtrip"]
+    ), file=f)
+    print("%-10s %10s %10s %12s" % ("phase", "time", "median", "peak RSS"), end="", file=f)
+    if old:
+        print("   %10s %8s  (%s)" % ("old time", "ratio", old["rev"]), end="", file=f)
+    print(file=f)
+    for phase, d in res["phases"].items():
+        rss = "-" if d["peak_rss_kb"] is None else "%.1f MiB" % (d["peak_rss_kb"] / 1024)
+        print("%-10s %10.3f %10.3f %12s" % (phase, d["time"], d["time_median"], rss), end="", file=f)
+        if old and phase in old["phases"]:
+            old_t = old["phases"][phase]["time"]
+            ratio = "%.2fx" % (d["time"] / old_t) if old_t else "-"
+            print("   %10.3f %8s" % (old_t, ratio), end="", file=f)
+        print(file=f)
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Benchmark import/export/round-trip of synthetic PortfolioPerformance XML file")
+    argp.add_argument("--size", choices=SIZES.keys(), default="medium", help="preset size of generated file (default: %(default)s)")
+    argp.add_argument("--gen-opts", default="", help="additional options for gen_ppxml.py, overriding the preset (e.g. \"--prices 10000\")")
+    argp.add_argument("--import-opts", default="", help="options for ppxml2db.py (use --import-opts=\"...\" form)")
+    argp.add_argument("--export-opts", default="", help="options for db2ppxml.py (use --export-opts=\"...\" form)")
+    argp.add_argument("--repeat", type=int, default=3, help="number of runs (default: %(default)s)")
+    argp.add_argument("--dbtype", choices=("sqlite", "pgsql"), default="sqlite", help="select database type")
+    argp.add_argument("--db", help="DB (filename/connect string, required for pgsql; its tables are recreated!)")
+    argp.add_argument("--workdir", help="dir for generated and output files (temporary dir by default)")
+    argp.add_argument("--json", help="save results to this JSON file")
+    argp.add_argument("--compare", help="compare with results saved previously using --json")
+    args = argp.parse_args()
+    if args.dbtype == "pgsql" and not args.db:
+        argp.error("--db is required for pgsql")
+
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        res = bench(args, os.path.abspath(args.workdir))
+    else:
+        with tempfile.TemporaryDirectory(prefix="ppxml2db-bench-") as workdir:
+            res = bench(args, workdir)
+
+    report(res, old)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(res, f, indent=2)
+            f.write("\n")
+
+    if res["roundtrip"] != "ok":
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
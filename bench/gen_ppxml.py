@@ -0,0 +1,639 @@
+# Generate synthetic PortfolioPerformance XML file ("XML with id attributes"
+# variant) of configurable size, for benchmarking. Output is deterministic
+# for the given parameters and seed, and is formatted the same way as
+# db2ppxml.py outputs it, so it must round-trip byte-for-byte.
+import sys
+import argparse
+import random
+import datetime
+import uuid as uuid_mod
+
+
+class XMLWriter:
+
+    def __init__(self, out):
+        self.out = out
+        self.depth = 0
+
+    def _indent(self):
+        if self.depth:
+            self.out.write("\n" + "  " * self.depth)
+
+    @staticmethod
+    def _attrs(attrs):
+        return "".join(' %s="%s"' % kv for kv in attrs)
+
+    def start(self, tag, *attrs):
+        self._indent()
+        self.out.write("<%s%s>" % (tag, self._attrs(attrs)))
+        self.depth += 1
+
+    def end(self, tag):
+        self.depth -= 1
+        self._indent()
+        if self.depth == 0:
+            self.out.write("\n")
+        self.out.write("</%s>" % tag)
+
+    def empty(self, tag, *attrs):
+        self._indent()
+        self.out.write("<%s%s/>" % (tag, self._attrs(attrs)))
+
+    def leaf(self, tag, text, *attrs):
+        if text is None:
+            return
+        self._indent()
+        self.out.write("<%s%s>%s</%s>" % (tag, self._attrs(attrs), quote_text(str(text)), tag))
+
+
+def quote_text(s):
+    return (s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            .replace('"', "&quot;").replace("'", "&apos;"))
+
+
+class Generator:
+
+    ATTR_TYPES = [
+        ("logo", "Logo", "Logo", "security", "name.abuchen.portfolio.model.Security", "java.lang.String", "name.abuchen.portfolio.model.AttributeType$ImageConverter", "string"),
+        ("ter", "Total Expense Ratio", "TER", "security", "name.abuchen.portfolio.model.Security", "java.lang.Double", "name.abuchen.portfolio.model.AttributeType$PercentConverter", "double"),
+        ("limit", "Limit", "Limit", None, "name.abuchen.portfolio.model.Security", "name.abuchen.portfolio.model.LimitPrice", "name.abuchen.portfolio.model.AttributeType$LimitPriceConverter", "limitPrice"),
+    ]
+
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.xml_id = 0
+        self.uuid2xmlid = {}
+        self.cross_done = {}
+
+    def uuid(self):
+        return str(uuid_mod.UUID(int=self.rnd.getrandbits(128), version=4))
+
+    START_DATE = datetime.date(2000, 1, 1)
+
+    def date(self, day):
+        return (self.START_DATE + datetime.timedelta(days=day)).isoformat()
+
+    def updated_at(self):
+        return "2024-%02d-%02dT%02d:%02d:%02d.%06dZ" % (
+            self.rnd.randint(1, 12), self.rnd.randint(1, 28), self.rnd.randint(0, 23),
+            self.rnd.randint(0, 59), self.rnd.randint(0, 59), self.rnd.randint(0, 999999)
+        )
+
+    def next_id(self, uuid=None):
+        self.xml_id += 1
+        if uuid is not None:
+            self.uuid2xmlid[uuid] = self.xml_id
+        return ("id", str(self.xml_id))
+
+    def ref(self, uuid):
+        return ("reference", str(self.uuid2xmlid[uuid]))
+
+    # Model generation
+
+    def make_model(self):
+        a = self.args
+        rnd = self.rnd
+        self.securities = []
+        for i in range(a.securities):
+            cur = "USD" if i % 4 == 0 else "EUR"
+            sec = {
+                "uuid": self.uuid(),
+                "name": "Security %d %s" % (i, "& Co <A>" if i % 7 == 3 else "Inc"),
+                "currency": cur,
+                "isin": "DE%010d" % i,
+                "tickerSymbol": "SEC%d" % i,
+                "wkn": "W%05d" % i if i % 3 == 0 else None,
+                "note": "Note for 'security' %d" % i if i % 5 == 0 else None,
+                "feed": "MANUAL" if i % 2 else "YAHOO",
+                # Prices are generated when rendering, from their own
+                # random stream, so they're not kept in memory.
+                "price_seed": rnd.getrandbits(32),
+                "latest": None,
+                "attrs": [],
+                "events": [],
+                "props": [],
+                "updatedAt": self.updated_at(),
+            }
+            if a.prices and i % 2 == 0:
+                # Volume, the rest is taken from the last price
+                sec["latest"] = rnd.randint(0, 100000)
+            if i % 3 == 0:
+                sec["attrs"].append(("logo", "string", "data:image/png;base64,AAAA%d" % i))
+            if i % 4 == 0:
+                sec["attrs"].append(("ter", "double", "0.%03d" % (i % 1000)))
+            if i % 5 == 0:
+                sec["attrs"].append(("limit", "limitPrice", "GREATER_OR_EQUAL %d" % (i * 10000)))
+            for e in range(i % 3):
+                sec["events"].append((self.date(100 + e * 50), "STOCK_SPLIT" if e else "NOTE", "%d:1 event %d" % (e + 2, e)))
+            if i % 6 == 0:
+                sec["props"].append(("MARKET", "XETRA", "X%d" % i))
+                sec["props"].append(("FEED", "ALPHAVANTAGE", None if i % 12 else "av%d" % i))
+            self.securities.append(sec)
+
+        self.xacts = {}
+        self.accounts = []
+        for i in range(a.accounts):
+            self.accounts.append({
+                "uuid": self.uuid(), "name": "Account %d" % i, "currency": "EUR",
+                "note": "Cash & stuff" if i % 2 else None, "xacts": [],
+                "updatedAt": self.updated_at(),
+            })
+        self.portfolios = []
+        for i in range(a.portfolios):
+            self.portfolios.append({
+                "uuid": self.uuid(), "name": "Portfolio %d" % i,
+                # Reference account is kept to the first account, which is
+                # always output before any portfolio refers to it.
+                "refacc": self.accounts[0]["uuid"], "xacts": [],
+                "updatedAt": self.updated_at(),
+            })
+        self.acc_by_uuid = {acc["uuid"]: acc for acc in self.accounts + self.portfolios}
+
+        day = 0
+        for n in range(a.xacts):
+            day += rnd.randint(0, 3)
+            r = rnd.random()
+            if r < a.cross_ratio and self.portfolios and self.securities:
+                port = rnd.choice(self.portfolios)
+                acc = self.acc_by_uuid[port["refacc"]]
+                sec = rnd.choice(self.securities)
+                typ = rnd.choice(("BUY", "SELL"))
+                shares = rnd.randint(1, 1000) * 100000000
+                amount = rnd.randint(100, 100000) * 100
+                units = [("FEE", rnd.randint(100, 2000), "EUR", None)]
+                if sec["currency"] != "EUR":
+                    units.append(("GROSS_VALUE", amount, "EUR", (int(amount * 1.1), sec["currency"], "0.9090909090")))
+                px = self.new_xact(port, typ, day, amount, sec["uuid"], shares, units)
+                ax = self.new_xact(acc, typ, day, amount, sec["uuid"], 0, [])
+                cross = {"type": "buysell", "from_acc": port["uuid"], "from_xact": px["uuid"], "to_acc": acc["uuid"], "to_xact": ax["uuid"]}
+                px["cross"] = ax["cross"] = cross
+            elif r < a.cross_ratio + (1 - a.cross_ratio) / 4 and len(self.accounts) > 1:
+                acc_from, acc_to = rnd.sample(self.accounts, 2)
+                amount = rnd.randint(100, 100000) * 100
+                fx = self.new_xact(acc_from, "TRANSFER_OUT", day, amount, None, 0, [])
+                tx = self.new_xact(acc_to, "TRANSFER_IN", day, amount, None, 0, [])
+                cross = {"type": "account-transfer", "from_acc": acc_from["uuid"], "from_xact": fx["uuid"], "to_acc": acc_to["uuid"], "to_xact": tx["uuid"]}
+                fx["cross"] = tx["cross"] = cross
+            elif r < a.cross_ratio + (1 - a.cross_ratio) / 3 and len(self.portfolios) > 1 and self.securities:
+                p_from, p_to = rnd.sample(self.portfolios, 2)
+                sec = rnd.choice(self.securities)
+                shares = rnd.randint(1, 1000) * 100000000
+                amount = rnd.randint(100, 100000) * 100
+                fx = self.new_xact(p_from, "TRANSFER_OUT", day, amount, sec["uuid"], shares, [])
+                tx = self.new_xact(p_to, "TRANSFER_IN", day, amount, sec["uuid"], shares, [])
+                cross = {"type": "portfolio-transfer", "from_acc": p_from["uuid"], "from_xact": fx["uuid"], "to_acc": p_to["uuid"], "to_xact": tx["uuid"]}
+                fx["cross"] = tx["cross"] = cross
+            else:
+                acc = rnd.choice(self.accounts)
+                typ = rnd.choice(("DEPOSIT", "REMOVAL", "INTEREST", "DIVIDENDS", "FEES"))
+                sec = None
+                units = []
+                if typ == "DIVIDENDS" and self.securities:
+                    sec = rnd.choice(self.securities)["uuid"]
+                    units = [("TAX", rnd.randint(100, 2000), "EUR", None)]
+                self.new_xact(acc, typ, day, rnd.randint(100, 100000) * 100, sec, 0, units)
+
+        self.watchlists = []
+        for i in range(a.watchlists):
+            secs = [s["uuid"] for s in self.securities[i::max(1, a.watchlists)]]
+            self.watchlists.append({"name": "Watchlist %d" % i, "securities": secs})
+
+        self.taxonomies = []
+        for i in range(a.taxonomies):
+            tax = {"uuid": self.uuid(), "name": "Taxonomy %d" % i,
+                   "dimensions": ["dim%d" % i] if i % 2 else []}
+            tax["root"] = self.make_category(a.taxonomy_depth, 0)
+            self.taxonomies.append(tax)
+
+    def make_category(self, depth, level):
+        rnd = self.rnd
+        cat = {
+            "uuid": self.uuid(), "name": "Category L%d %d" % (level, rnd.randint(0, 999)),
+            "color": "#%06x" % rnd.getrandbits(24), "weight": 10000, "rank": level,
+            "children": [], "assignments": [], "data": [],
+        }
+        if level and rnd.random() < 0.3:
+            cat["data"].append(("note", "string", "Data for category"))
+        if depth > 0:
+            for i in range(2):
+                cat["children"].append(self.make_category(depth - 1, level + 1))
+        else:
+            for j in range(2):
+                if self.securities:
+                    s = rnd.choice(self.securities)
+                    data = [("note", "string", "assigned")] if j else []
+                    cat["assignments"].append(("security", s["uuid"], rnd.randint(0, 10000), j, data))
+            if self.accounts:
+                cat["assignments"].append(("account", rnd.choice(self.accounts)["uuid"], 10000, 0, []))
+        return cat
+
+    def prices(self, sec):
+        rnd = random.Random(sec["price_seed"])
+        v = rnd.randint(1000, 500000) * 10000
+        for d in range(self.args.prices):
+            v = max(10000, v + rnd.randint(-v // 50, v // 50))
+            yield self.date(d), v
+
+    def new_xact(self, owner, typ, day, amount, sec, shares, units):
+        x = {
+            "uuid": self.uuid(),
+            "acctype": "portfolio" if owner in self.portfolios else "account",
+            "date": self.date(day) + "T00:00",
+            "currency": "EUR",
+            "amount": amount,
+            "security": sec,
+            "shares": shares,
+            "note": "Note <%d> & 'quoted'" % amount if self.rnd.random() < 0.1 else None,
+            "source": "import.csv" if self.rnd.random() < 0.05 else None,
+            "units": units,
+            "updatedAt": self.updated_at(),
+            "type": typ,
+            "cross": None,
+        }
+        self.xacts[x["uuid"]] = x
+        owner["xacts"].append(x)
+        return x
+
+    # Rendering, mirrors db2ppxml.py traversal order.
+
+    def render(self, out):
+        w = self.w = XMLWriter(out)
+        w.start("client", self.next_id())
+        w.leaf("version", "56")
+        w.leaf("baseCurrency", "EUR")
+        self.render_securities()
+        self.render_watchlists()
+        if self.accounts:
+            w.start("accounts")
+            for acc in self.accounts:
+                self.render_account("account", acc)
+            w.end("accounts")
+        else:
+            w.empty("accounts")
+        if self.portfolios:
+            w.start("portfolios")
+            for port in self.portfolios:
+                self.render_portfolio("portfolio", port)
+            w.end("portfolios")
+        else:
+            w.empty("portfolios")
+        w.empty("plans")
+        self.render_taxonomies()
+        self.render_dashboards()
+        w.start("properties")
+        self.render_entry("portfolio-chart-details", "50")
+        self.render_entry("security-chart-details", "SHOW_MARKER_LINES,SHOW_DATA_LABELS")
+        w.end("properties")
+        self.render_settings()
+        w.end("client")
+
+    def render_entry(self, k, v, typ="string"):
+        w = self.w
+        w.start("entry")
+        w.leaf("string", k)
+        w.leaf(typ, v)
+        w.end("entry")
+
+    def render_securities(self):
+        w = self.w
+        if not self.securities:
+            w.empty("securities")
+            return
+        w.start("securities")
+        for sec in self.securities:
+            w.start("security", self.next_id(sec["uuid"]))
+            w.leaf("uuid", sec["uuid"])
+            w.leaf("name", sec["name"])
+            w.leaf("currencyCode", sec["currency"])
+            w.leaf("note", sec["note"])
+            w.leaf("isin", sec["isin"])
+            w.leaf("tickerSymbol", sec["tickerSymbol"])
+            w.leaf("wkn", sec["wkn"])
+            w.leaf("feed", sec["feed"])
+            if self.args.prices:
+                w.start("prices")
+                for t, v in self.prices(sec):
+                    w.empty("price", ("t", t), ("v", v))
+                w.end("prices")
+            else:
+                w.empty("prices")
+            if sec["latest"] is not None:
+                w.start("latest", ("t", t), ("v", v))
+                w.leaf("high", v + 100)
+                w.leaf("low", v - 100)
+                w.leaf("volume", sec["latest"])
+                w.end("latest")
+            self.render_attributes(sec["attrs"])
+            if sec["events"]:
+                w.start("events")
+                for date, typ, details in sec["events"]:
+                    w.start("event")
+                    w.leaf("date", date)
+                    w.leaf("type", typ)
+                    w.leaf("details", details)
+                    w.end("event")
+                w.end("events")
+            else:
+                w.empty("events")
+            for typ, name, value in sec["props"]:
+                if value is None:
+                    w.empty("property", ("type", typ), ("name", name))
+                else:
+                    w.leaf("property", value, ("type", typ), ("name", name))
+            w.leaf("isRetired", "false")
+            w.leaf("updatedAt", sec["updatedAt"])
+            w.end("security")
+        w.end("securities")
+
+    def render_attributes(self, attrs):
+        w = self.w
+        w.start("attributes")
+        if not attrs:
+            w.empty("map")
+        else:
+            w.start("map")
+            for attr_id, typ, value in attrs:
+                w.start("entry")
+                w.leaf("string", attr_id)
+                if typ == "limitPrice":
+                    op, val = value.split(" ", 1)
+                    w.start(typ)
+                    w.leaf("operator", op)
+                    w.leaf("value", val)
+                    w.end(typ)
+                else:
+                    w.leaf(typ, value)
+                w.end("entry")
+            w.end("map")
+        w.end("attributes")
+
+    def render_watchlists(self):
+        w = self.w
+        if not self.watchlists:
+            w.empty("watchlists")
+            return
+        w.start("watchlists")
+        for wl in self.watchlists:
+            w.start("watchlist", self.next_id())
+            w.leaf("name", wl["name"])
+            if wl["securities"]:
+                w.start("securities")
+                for s in wl["securities"]:
+                    w.empty("security", self.ref(s))
+                w.end("securities")
+            else:
+                w.empty("securities")
+            w.end("watchlist")
+        w.end("watchlists")
+
+    def render_account(self, tag, acc):
+        w = self.w
+        if acc["uuid"] in self.uuid2xmlid:
+            w.empty(tag, self.ref(acc["uuid"]))
+            return
+        w.start(tag, self.next_id(acc["uuid"]))
+        w.leaf("uuid", acc["uuid"])
+        w.leaf("name", acc["name"])
+        w.leaf("currencyCode", acc["currency"])
+        w.leaf("note", acc["note"])
+        w.leaf("isRetired", "false")
+        self.render_xacts(acc)
+        self.render_attributes([])
+        w.leaf("updatedAt", acc["updatedAt"])
+        w.end(tag)
+
+    def render_portfolio(self, tag, port):
+        w = self.w
+        if port["uuid"] in self.uuid2xmlid:
+            w.empty(tag, self.ref(port["uuid"]))
+            return
+        w.start(tag, self.next_id(port["uuid"]))
+        w.leaf("uuid", port["uuid"])
+        w.leaf("name", port["name"])
+        w.leaf("isRetired", "false")
+        self.render_account("referenceAccount", self.acc_by_uuid[port["refacc"]])
+        self.render_xacts(port)
+        self.render_attributes([])
+        w.leaf("updatedAt", port["updatedAt"])
+        w.end(tag)
+
+    def render_xacts(self, owner):
+        w = self.w
+        if not owner["xacts"]:
+            w.empty("transactions")
+            return
+        w.start("transactions")
+        for x in owner["xacts"]:
+            self.render_xact(x["acctype"] + "-transaction", x)
+        w.end("transactions")
+
+    def render_xact(self, tag, x):
+        w = self.w
+        if x["uuid"] in self.uuid2xmlid:
+            w.empty(tag, self.ref(x["uuid"]))
+            return
+        w.start(tag, self.next_id(x["uuid"]))
+        w.leaf("uuid", x["uuid"])
+        w.leaf("date", x["date"])
+        w.leaf("currencyCode", x["currency"])
+        w.leaf("amount", x["amount"])
+        if x["security"] is not None:
+            w.empty("security", self.ref(x["security"]))
+        c = x["cross"]
+        if c is not None:
+            key = (c["type"], c["from_xact"], c["to_xact"])
+            if key in self.cross_done:
+                w.empty("crossEntry", ("class", c["type"]), ("reference", self.cross_done[key]))
+            else:
+                id_attr = self.next_id()
+                self.cross_done[key] = id_attr[1]
+                w.start("crossEntry", ("class", c["type"]), id_attr)
+                from_acc = self.acc_by_uuid[c["from_acc"]]
+                to_acc = self.acc_by_uuid[c["to_acc"]]
+                if c["type"] == "buysell":
+                    self.render_portfolio("portfolio", from_acc)
+                    self.render_xact("portfolioTransaction", self.xacts[c["from_xact"]])
+                    self.render_account("account", to_acc)
+                    self.render_xact("accountTransaction", self.xacts[c["to_xact"]])
+                elif c["type"] == "account-transfer":
+                    self.render_account("accountFrom", from_acc)
+                    self.render_xact("transactionFrom", self.xacts[c["from_xact"]])
+                    self.render_account("accountTo", to_acc)
+                    self.render_xact("transactionTo", self.xacts[c["to_xact"]])
+                else:
+                    self.render_portfolio("portfolioFrom", from_acc)
+                    self.render_xact("transactionFrom", self.xacts[c["from_xact"]])
+                    self.render_portfolio("portfolioTo", to_acc)
+                    self.render_xact("transactionTo", self.xacts[c["to_xact"]])
+                w.end("crossEntry")
+        w.leaf("shares", x["shares"])
+        w.leaf("note", x["note"])
+        w.leaf("source", x["source"])
+        if x["units"]:
+            w.start("units")
+            for typ, amount, cur, forex in x["units"]:
+                w.start("unit", ("type", typ))
+                w.empty("amount", ("currency", cur), ("amount", amount))
+                if forex is not None:
+                    w.empty("forex", ("currency", forex[1]), ("amount", forex[0]))
+                    w.leaf("exchangeRate", forex[2])
+                w.end("unit")
+            w.end("units")
+        w.leaf("updatedAt", x["updatedAt"])
+        w.leaf("type", x["type"])
+        w.end(tag)
+
+    def render_taxonomies(self):
+        w = self.w
+        if not self.taxonomies:
+            w.empty("taxonomies")
+            return
+        w.start("taxonomies")
+        for tax in self.taxonomies:
+            w.start("taxonomy")
+            w.leaf("id", tax["uuid"])
+            w.leaf("name", tax["name"])
+            if tax["dimensions"]:
+                w.start("dimensions")
+                for d in tax["dimensions"]:
+                    w.leaf("string", d)
+                w.end("dimensions")
+            self.render_category(tax["root"], None)
+            w.end("taxonomy")
+        w.end("taxonomies")
+
+    def render_category(self, cat, parent):
+        w = self.w
+        tag = "root" if parent is None else "classification"
+        w.start(tag, self.next_id(cat["uuid"]))
+        w.leaf("id", cat["uuid"])
+        w.leaf("name", cat["name"])
+        w.leaf("color", cat["color"])
+        if parent is not None:
+            w.empty("parent", self.ref(parent))
+        if cat["children"]:
+            w.start("children")
+            for ch in cat["children"]:
+                self.render_category(ch, cat["uuid"])
+            w.end("children")
+        else:
+            w.empty("children")
+        if cat["assignments"]:
+            w.start("assignments")
+            for item_type, item, weight, rank, data in cat["assignments"]:
+                w.start("assignment")
+                w.empty("investmentVehicle", ("class", item_type), self.ref(item))
+                w.leaf("weight", weight)
+                w.leaf("rank", rank)
+                self.render_data(data)
+                w.end("assignment")
+            w.end("assignments")
+        else:
+            w.empty("assignments")
+        w.leaf("weight", cat["weight"])
+        w.leaf("rank", cat["rank"])
+        self.render_data(cat["data"])
+        w.end(tag)
+
+    def render_data(self, data):
+        if data:
+            self.w.start("data")
+            for name, typ, value in data:
+                self.render_entry(name, value, typ)
+            self.w.end("data")
+
+    def render_dashboards(self):
+        w = self.w
+        w.start("dashboards")
+        w.start("dashboard", ("name", "Dashboard"))
+        w.leaf("id", "dashboard-1")
+        w.start("configuration")
+        self.render_entry("REPORTING_PERIOD", "L1Y0")
+        w.end("configuration")
+        w.start("columns")
+        for i in range(2):
+            w.start("column")
+            w.leaf("weight", "1")
+            w.start("widgets")
+            w.start("widget", ("type", "HEADING"))
+            w.leaf("label", "Widget %d" % i)
+            if i:
+                w.start("configuration")
+                self.render_entry("DATA_SERIES", "Client-totals")
+                w.end("configuration")
+            w.end("widget")
+            w.end("widgets")
+            w.end("column")
+        w.end("columns")
+        w.end("dashboard")
+        w.end("dashboards")
+
+    def render_settings(self):
+        w = self.w
+        w.start("settings")
+        w.start("bookmarks")
+        w.start("bookmark")
+        w.leaf("label", "Google")
+        w.leaf("pattern", "https://www.google.com/search?q={isin}&tbm=fin")
+        w.end("bookmark")
+        w.end("bookmarks")
+        w.start("attributeTypes")
+        for id, name, label, source, target, typ, conv, _ in self.ATTR_TYPES:
+            w.start("attribute-type")
+            w.leaf("id", id)
+            w.leaf("name", name)
+            w.leaf("columnLabel", label)
+            w.leaf("source", source)
+            w.leaf("target", target)
+            w.leaf("type", typ)
+            w.leaf("converterClass", conv)
+            if typ.endswith("LimitPrice"):
+                w.empty("properties")
+            w.end("attribute-type")
+        w.end("attributeTypes")
+        w.start("configurationSets")
+        w.start("entry")
+        w.leaf("string", "security-performance-chart")
+        w.start("config-set")
+        w.start("configurations")
+        w.start("config")
+        w.leaf("uuid", "cfg-1")
+        w.leaf("name", "Standard")
+        w.leaf("data", "COLUMN,1;COLUMN,2")
+        w.end("config")
+        w.end("configurations")
+        w.end("config-set")
+        w.end("entry")
+        w.end("configurationSets")
+        w.end("settings")
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Generate synthetic PortfolioPerformance XML file")
+    argp.add_argument("xml_file", nargs="?", help="output XML file (stdout if not provided)")
+    argp.add_argument("--securities", type=int, default=20, help="number of securities (default: %(default)s)")
+    argp.add_argument("--prices", type=int, default=200, help="historical prices per security (default: %(default)s)")
+    argp.add_argument("--accounts", type=int, default=3, help="number of (deposit) accounts (default: %(default)s)")
+    argp.add_argument("--portfolios", type=int, default=2, help="number of portfolios (securities accounts) (default: %(default)s)")
+    argp.add_argument("--xacts", type=int, default=500, help="number of transaction events, cross entries produce 2 transactions each (default: %(default)s)")
+    argp.add_argument("--cross-ratio", type=float, default=0.5, help="share of buy/sell transactions, having cross entries; transfers get a part of the rest (default: %(default)s)")
+    argp.add_argument("--watchlists", type=int, default=2, help="number of watchlists (default: %(default)s)")
+    argp.add_argument("--taxonomies", type=int, default=2, help="number of taxonomies (default: %(default)s)")
+    argp.add_argument("--taxonomy-depth", type=int, default=3, help="depth of (binary) taxonomy category trees (default: %(default)s)")
+    argp.add_argument("--seed", type=int, default=1, help="random seed (default: %(default)s)")
+    args = argp.parse_args()
+    if args.portfolios and not args.accounts:
+        argp.error("portfolios require at least one account (as reference account)")
+
+    gen = Generator(args)
+    gen.make_model()
+    out = sys.stdout
+    if args.xml_file:
+        out = open(args.xml_file, "w", encoding="utf-8", newline="\n")
+    gen.render(out)
+    out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+# Compact in-memory representation of uuids, for maps which have an entry
+# per object (transaction, etc.) and thus may get really large: a uuid
+# string takes 85 bytes, while 16-byte bytes object takes 49.
+
+
+# Canonical (lowercase, hyphenated) uuid strings are packed into 16 bytes,
+# anything else is returned as is (so can still be used as a dict key).
+def pack_uuid(s):
+    if s is not None and len(s) == 36 and s[8] == s[13] == s[18] == s[23] == "-":
+        try:
+            b = bytes.fromhex(s.replace("-", ""))
+        except ValueError:
+            return s
+        # Make sure that it unpacks back to the same string (e.g. not
+        # uppercase).
+        if len(b) == 16 and unpack_uuid(b) == s:
+            return b
+    return s
+
+
+def unpack_uuid(v):
+    if v.__class__ is bytes:
+        h = v.hex()
+        return "%s-%s-%s-%s-%s" % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+    return v
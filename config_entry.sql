@@ -4,3 +4,5 @@ uuid VARCHAR(255), -- not really a uuid, more like id
 name VARCHAR(255),
 data TEXT
 );
+
+CREATE INDEX config_entry__config_set ON config_entry(config_set);
@@ -1,30 +1,94 @@
 import sys
 import argparse
 import logging
-import os.path
 import json
+import re
+import io
+import multiprocessing
 
 from version import __version__
 import dbhelper
+import fileio
+from stats import Stats
+from compact import pack_uuid
+import mapping
 
 
-# uuid to #
-sec_map = {}
+_log = logging.getLogger(__name__)
 
-# uuid to element
-output_els = {}
-
-# (portfolio_xact, account_xact) to element
+# (type, from_xact, to_xact) of cross entries output so far (and not yet
+# referenced) to their xmlid
 cross_els = {}
 
 xml_id = 0
+# Packed uuid (see compact.py) to (int) xmlid of objects output so far
 uuid2xmlid = {}
 
 out = None
 
+# Prefetcher instance, if --prefetch is used
+prefetcher = None
+
+price_stream = None
+
+# Sets of uuids of securities and accounts/portfolios to export, if the
+# export is filtered (--securities/--accounts), None otherwise.
+sec_filter = None
+acc_filter = None
+
+
+# Output stream: collects written strings in a list (appending to it is much
+# cheaper than a write() call on a text file), and writes them out to the
+# underlying binary file in large UTF-8 encoded chunks.
+class BufferedOut:
+
+    # Max number of strings to collect before writing them out
+    CHUNK_SIZE = 16384
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = []
+        self.write = self.buf.append
+
+    # To be called periodically to write out collected strings.
+    def check(self):
+        if len(self.buf) >= self.CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.f.write("".join(self.buf).encode("utf-8"))
+        self.buf.clear()
+
+    # Write already encoded output.
+    def write_raw(self, data):
+        self.flush()
+        self.f.write(data)
+
+    def close(self):
+        self.flush()
+        self.f.flush()
+        if self.f is not sys.stdout.buffer:
+            self.f.close()
+
+
+# Newline and indentation before a tag of a given nesting level, computed
+# on demand.
+class Indents(dict):
+
+    def __missing__(self, level):
+        s = self[level] = "\n" + "  " * level
+        return s
+
+
+INDENTS = Indents({0: ""})
+# Top-level closing tag is put on a separate line too.
+END_INDENTS = Indents({0: "\n"})
+
 
 class ET_SubElement:
 
+    __slots__ = ("_indent", "tag", "attrib", "start_written")
+
     def __init__(self, parent, tag):
         if parent is None:
             self._indent = 0
@@ -42,18 +106,14 @@ class ET_SubElement:
     def set(self, attr, val):
         self.attrib[attr] = val
 
-    def indent(self):
-        global out
-        if self._indent:
-            out.write("\n" + "  " * self._indent)
+    def _start_tag(self, end):
+        if self.attrib:
+            attrs = "".join([' %s="%s"' % kv for kv in self.attrib.items()])
+            return "%s<%s%s%s" % (INDENTS[self._indent], self.tag, attrs, end)
+        return "%s<%s%s" % (INDENTS[self._indent], self.tag, end)
 
     def _wr_start(self, end):
-        global out
-        self.indent()
-        out.write("<%s" % self.tag)
-        for k, v in self.attrib.items():
-            out.write(' %s="%s"' % (k, v))
-        out.write(end)
+        out.write(self._start_tag(end))
         self.start_written = True
 
     def wr_start(self):
@@ -63,17 +123,15 @@ class ET_SubElement:
         self._wr_start("/>")
 
     def wr_end(self, indent=True):
-        global out
         if not self.start_written:
             self.wr_nb()
             return
 
         if indent:
-            self.indent()
-            # Still need to indent top closing tag
-            if self._indent == 0:
-                out.write("\n")
-        out.write("</%s>" % self.tag)
+            out.write("%s</%s>" % (END_INDENTS[self._indent], self.tag))
+        else:
+            out.write("</%s>" % self.tag)
+        out.check()
 
     @property
     def text(self):
@@ -81,13 +139,12 @@ class ET_SubElement:
 
     @text.setter
     def text(self, txt):
-        global out
         if txt is None:
             self.wr_nb()
         else:
-            self.wr_start()
-            out.write(quote_text(txt))
-            self.wr_end(False)
+            # Write whole element at once.
+            out.write("%s%s</%s>" % (self._start_tag(">"), quote_text(txt), self.tag))
+            self.start_written = True
 
 
 def ET_Element(tag):
@@ -109,7 +166,7 @@ def add_xmlid(el, uuid=None):
     xml_id += 1
     el.attrib["id"] = str(xml_id)
     if uuid is not None:
-        uuid2xmlid[uuid] = str(xml_id)
+        uuid2xmlid[pack_uuid(uuid)] = xml_id
 
 
 def ET_SubElementWId(parent, tag, uuid=None):
@@ -122,10 +179,59 @@ def as_bool(v):
     return ["false", "true"][v]
 
 
-def make_prop(pel, row, prop, row_prop=None, conv=str):
-    if row[row_prop or prop] is not None:
-        el = ET.SubElement(pel, prop)
-        el.text = conv(row[row_prop or prop])
+# Compile element mapping (see mapping.py) into list of functions (one
+# per group of fields) writing fields from a row as children of the given
+# element (or its attributes, which must be set before any children), in
+# a single write.
+def compile_emitters(groups):
+    return [compile_emitter(group) for group in groups]
+
+
+def compile_emitter(group):
+    attrs = []
+    children = []
+    for f in group:
+        if f.kind == "attr":
+            attrs.append((f.tag, f.col))
+        elif f.kind != "xmlid":
+            children.append((f.col, "<%s>" % f.tag, "</%s>" % f.tag, as_bool if f.kind == "bool" else str))
+
+    def emit(el, row):
+        for tag, col in attrs:
+            el.attrib[tag] = str(row[col])
+        if not children:
+            return
+        indent = INDENTS[el._indent + 1]
+        parts = []
+        for col, start, end, conv in children:
+            v = row[col]
+            if v is not None:
+                parts.append("%s%s%s%s" % (indent, start, quote_text(conv(v)), end))
+        if parts:
+            if not el.start_written:
+                el.wr_start()
+            out.write("".join(parts))
+
+    return emit
+
+
+emit_security_head, emit_security_feed, emit_security_tail = compile_emitters(mapping.SECURITY)
+emit_latest_price, = compile_emitters(mapping.LATEST_PRICE)
+emit_security_event, = compile_emitters(mapping.SECURITY_EVENT)
+emit_watchlist, = compile_emitters(mapping.WATCHLIST)
+emit_account_head, emit_account_tail = compile_emitters(mapping.ACCOUNT)
+emit_portfolio_head, emit_portfolio_tail = compile_emitters(mapping.PORTFOLIO)
+emit_xact_head, emit_xact_mid, emit_xact_tail = compile_emitters(mapping.XACT)
+emit_taxonomy, = compile_emitters(mapping.TAXONOMY)
+emit_taxonomy_category_head, emit_taxonomy_category_tail = compile_emitters(mapping.TAXONOMY_CATEGORY)
+emit_taxonomy_assignment, = compile_emitters(mapping.TAXONOMY_ASSIGNMENT)
+emit_dashboard, = compile_emitters(mapping.DASHBOARD)
+emit_dashboard_column, = compile_emitters(mapping.DASHBOARD_COLUMN)
+emit_dashboard_widget, = compile_emitters(mapping.DASHBOARD_WIDGET)
+emit_bookmark, = compile_emitters(mapping.BOOKMARK)
+emit_attribute_type, = compile_emitters(mapping.ATTRIBUTE_TYPE)
+emit_config_set, = compile_emitters(mapping.CONFIG_SET)
+emit_config_entry, = compile_emitters(mapping.CONFIG_ENTRY)
 
 
 def make_map(pel, rows):
@@ -181,7 +287,7 @@ def make_data_entries(pel, data_rows):
 
 
 def security_ref(uuid, levels=4):
-    return uuid2xmlid[uuid]
+    return str(uuid2xmlid[pack_uuid(uuid)])
 
 
 def make_ref(etree, el, to_el):
@@ -189,77 +295,270 @@ def make_ref(etree, el, to_el):
 
 
 def try_ref(etree, el, uuid):
-    if uuid in uuid2xmlid:
-        el.set("reference", uuid2xmlid[uuid])
+    xmlid = uuid2xmlid.get(pack_uuid(uuid))
+    if xmlid is not None:
+        el.set("reference", str(xmlid))
         el.wr_nb()
         return True
     return False
 
 
+def events_order():
+    if args.sort_events:
+        return "date, details"
+    return None
+
+
+# Instead of querying child tables per each parent row (N+1 queries), loads
+# each of them once and groups rows by key columns in memory. Trades memory
+# for the number of queries, so historical prices (the bulk of the data) are
+# not handled this way (see PriceStream instead).
+class Prefetcher:
+
+    # (table, key columns, order)
+    TABLES = [
+        ("latest_price", ("security",), None),
+        ("security_attr", ("security",), "seq"),
+        ("security_event", ("security",), events_order),
+        ("security_prop", ("security",), "seq"),
+        ("watchlist_security", ("list",), None),
+        ("account", ("uuid",), None),
+        ("account_attr", ("account",), "seq"),
+        ("xact", ("account", "uuid"), "_order"),
+        ("xact_unit", ("xact",), None),
+        ("xact_cross_entry", ("from_xact", "to_xact"), None),
+        ("taxonomy_category", ("uuid", "parent"), None),
+        ("taxonomy_data", ("taxonomy", "category"), None),
+        ("taxonomy_assignment", ("category",), None),
+        ("taxonomy_assignment_data", ("assignment",), None),
+        ("config_entry", ("config_set",), None),
+    ]
+
+    def __init__(self):
+        self.index = {}
+        for table, keys, order in self.TABLES:
+            if callable(order):
+                order = order()
+            # Per-row selects return rows in the physical order (for
+            # rows which compare equal by order, if any), keep it.
+            if dbhelper.dbtype == "sqlite":
+                order = "rowid" if order is None else order + ", rowid"
+            rows = dbhelper.select(table, order=order)
+            for key in keys:
+                idx = self.index[(table, key)] = {}
+                for r in rows:
+                    idx.setdefault(r[key], []).append(r)
+
+    def get(self, table, key, val):
+        return self.index[(table, key)].get(val, [])
+
+
+# Walks over prices of all securities with a single query, ordered the same
+# way as securities are output (by _id), then by date, fetching rows lazily.
+# This way, memory usage stays flat regardless of the price history size.
+class PriceStream:
+
+    # Optionally, only for securities with _id's in the given range and/or
+    # the given list, and prices since the given date (--prices-since).
+    def __init__(self, min_id=None, max_id=None, ids=None):
+        if args.no_prices or ids == []:
+            self.rows = iter(())
+            self.cur = None
+            return
+        conds = []
+        values = ()
+        if min_id is not None:
+            conds.append("security._id BETWEEN ? AND ?")
+            values += (min_id, max_id)
+        if ids is not None:
+            # _id's are integers, so can be inlined safely (and there may
+            # be more of them than allowed number of parameters).
+            conds.append("security._id IN (%s)" % ", ".join(str(int(i)) for i in ids))
+        if args.prices_since:
+            conds.append("price.tstamp >= ?")
+            values += (args.prices_since,)
+        where = ""
+        if conds:
+            where = " WHERE " + " AND ".join(conds)
+        self.rows = dbhelper.iter_query(
+            "SELECT security._id, price.tstamp, price.value FROM security"
+            " JOIN price ON price.security = security.uuid"
+            + where +
+            " ORDER BY security._id, price.tstamp",
+            values,
+            table="price"
+        )
+        self.cur = next(self.rows, None)
+
+    # Prices of a security (must be called in the order of security _id's)
+    def prices(self, sec_id):
+        while self.cur is not None and self.cur[0] < sec_id:
+            self.cur = next(self.rows, None)
+        while self.cur is not None and self.cur[0] == sec_id:
+            yield self.cur
+            self.cur = next(self.rows, None)
+
+
+def make_prices(pel, sec_r):
+    prices = ET.SubElement(pel, "prices")
+    if args.no_prices:
+        prices.wr_end()
+        return
+    indent = "\n" + "  " * (prices._indent + 1)
+    cnt = 0
+    for _, t, v in price_stream.prices(sec_r["_id"]):
+        if not prices.start_written:
+            prices.wr_start()
+        out.write('%s<price t="%s" v="%s"/>' % (indent, t, v))
+        cnt += 1
+        if not cnt % 1024:
+            out.check()
+    prices.wr_end()
+
+
+def select_by(table, key, val, order=None):
+    if prefetcher is not None:
+        return prefetcher.get(table, key, val)
+    return dbhelper.select_by(table, (key,), (val,), order=order)
+
+
+def select_cross_entries(xact_uuid):
+    if prefetcher is not None:
+        return prefetcher.get("xact_cross_entry", "from_xact", xact_uuid) + \
+            prefetcher.get("xact_cross_entry", "to_xact", xact_uuid)
+    return dbhelper.query("SELECT * FROM xact_cross_entry WHERE from_xact=? OR to_xact=?", (xact_uuid, xact_uuid), "xact_cross_entry")
+
+
+def select_taxonomy_dimensions(taxon_uuid):
+    if prefetcher is not None:
+        return [
+            r for r in prefetcher.get("taxonomy_data", "taxonomy", taxon_uuid)
+            if r["category"] is None and r["name"] == "dimension"
+        ]
+    return dbhelper.query("SELECT * FROM taxonomy_data WHERE taxonomy=? AND category IS NULL AND name='dimension'", (taxon_uuid,), "taxonomy_data")
+
+
+# Parse comma-separated values of a (repeatable) option.
+def split_opt(vals):
+    return [v.strip() for val in vals for v in val.split(",") if v.strip()]
+
+
+# Find uuids of rows of a table matching each of the given identifiers
+# (in any of the given columns).
+def resolve(table, cols, idents, what):
+    uuids = set()
+    sql = "SELECT uuid FROM %s WHERE %s" % (table, " OR ".join("%s=?" % c for c in cols))
+    for ident in idents:
+        rows = dbhelper.query(sql, (ident,) * len(cols))
+        if not rows:
+            sys.exit("No %s matching: %s" % (what, ident))
+        uuids.update(r[0] for r in rows)
+    return uuids
+
+
+# For a filtered export, compute the sets of securities and accounts to
+# export, so that the output is valid, i.e. anything referenced from them
+# is exported too: reference accounts of portfolios, accounts on the other
+# side of cross entries (transfers, buys/sells, etc.), and securities of
+# their transactions. Watchlists and taxonomy assignments are then limited
+# to the exported securities/accounts.
+def compute_filters():
+    global sec_filter, acc_filter
+    if not args.securities and not args.accounts:
+        return
+
+    securities = set()
+    if args.securities:
+        securities = resolve("security", ("uuid", "isin", "tickerSymbol", "name"), split_opt(args.securities), "security")
+
+    accounts = set()
+    if args.accounts:
+        accounts = resolve("account", ("uuid", "name"), split_opt(args.accounts), "account/portfolio")
+
+    # Accounts related to an account (in either direction).
+    related = {}
+    for from_acc, to_acc in dbhelper.query("SELECT DISTINCT from_acc, to_acc FROM xact_cross_entry"):
+        if from_acc is not None:
+            related.setdefault(from_acc, set()).add(to_acc)
+            related.setdefault(to_acc, set()).add(from_acc)
+    for uuid, ref_acc in dbhelper.query("SELECT uuid, referenceAccount FROM account WHERE referenceAccount IS NOT NULL"):
+        related.setdefault(uuid, set()).add(ref_acc)
+
+    todo = list(accounts)
+    while todo:
+        for acc in related.get(todo.pop(), ()):
+            if acc not in accounts:
+                accounts.add(acc)
+                todo.append(acc)
+
+    for acc in accounts:
+        for r in dbhelper.query("SELECT DISTINCT security FROM xact WHERE account=? AND security IS NOT NULL", (acc,)):
+            securities.add(r[0])
+
+    sec_filter = securities
+    acc_filter = accounts
+    _log.info("Exporting %d securities, %d accounts/portfolios", len(securities), len(accounts))
+
+
 def make_xact(etree, pel, tag, xact_r):
             xact = ET.SubElement(pel, tag)
             if try_ref(etree, xact, xact_r["uuid"]):
                 return
 
             add_xmlid(xact, xact_r["uuid"])
-            output_els[xact_r["uuid"]] = xact
-            make_prop(xact, xact_r, "uuid")
-            make_prop(xact, xact_r, "date")
-            make_prop(xact, xact_r, "currencyCode", "currency")
-            make_prop(xact, xact_r, "amount")
+            emit_xact_head(xact, xact_r)
             if xact_r["security"] is not None:
                 s = ET.SubElement(xact, "security")
                 #s.set("reference", security_ref(xact_r["security"], 5))
                 assert try_ref(etree, s, xact_r["security"])
 
             # 0 or 1
-            crit = "from_xact='%s' OR to_xact='%s'" % (xact_r["uuid"], xact_r["uuid"])
-            for x_r in dbhelper.select("xact_cross_entry", where=crit):
+            for x_r in select_cross_entries(xact_r["uuid"]):
                 #print(dict(x_r))
                 x = ET.SubElement(xact, "crossEntry")
                 x.set("class", x_r["type"])
                 cross_key = (x_r["type"], x_r["from_xact"], x_r["to_xact"])
-                existing_x = cross_els.get(cross_key)
+                # A cross entry is output (in full, then as a reference)
+                # only from its 2 transactions, so is not needed after that.
+                existing_x = cross_els.pop(cross_key, None)
                 if existing_x is not None:
-                    make_ref(etree, x, existing_x)
+                    x.set("reference", str(existing_x))
                     x.wr_nb()
                     continue
                 add_xmlid(x)
-                cross_els[cross_key] = x
+                cross_els[cross_key] = xml_id
                 if x_r["type"] == "account-transfer":
-                    accfrom_r = dbhelper.select("account", where="uuid='%s'" % x_r["from_acc"])[0]
+                    accfrom_r = select_by("account", "uuid", x_r["from_acc"])[0]
                     make_account(etree, x, accfrom_r, el_name="accountFrom")
-                    acc_xact_r = dbhelper.select("xact", where="uuid='%s'" % x_r["from_xact"])[0]
+                    acc_xact_r = select_by("xact", "uuid", x_r["from_xact"])[0]
                     make_xact(etree, x, "transactionFrom", acc_xact_r)
-                    accto_r = dbhelper.select("account", where="uuid='%s'" % x_r["to_acc"])[0]
+                    accto_r = select_by("account", "uuid", x_r["to_acc"])[0]
                     make_account(etree, x, accto_r, el_name="accountTo")
-                    acc_xact_r = dbhelper.select("xact", where="uuid='%s'" % x_r["to_xact"])[0]
+                    acc_xact_r = select_by("xact", "uuid", x_r["to_xact"])[0]
                     make_xact(etree, x, "transactionTo", acc_xact_r)
                 elif x_r["type"] == "portfolio-transfer":
-                    accfrom_r = dbhelper.select("account", where="uuid='%s'" % x_r["from_acc"])[0]
+                    accfrom_r = select_by("account", "uuid", x_r["from_acc"])[0]
                     make_portfolio(etree, x, accfrom_r["uuid"], el_name="portfolioFrom")
-                    acc_xact_r = dbhelper.select("xact", where="uuid='%s'" % x_r["from_xact"])[0]
+                    acc_xact_r = select_by("xact", "uuid", x_r["from_xact"])[0]
                     make_xact(etree, x, "transactionFrom", acc_xact_r)
-                    accto_r = dbhelper.select("account", where="uuid='%s'" % x_r["to_acc"])[0]
+                    accto_r = select_by("account", "uuid", x_r["to_acc"])[0]
                     make_portfolio(etree, x, accto_r["uuid"], el_name="portfolioTo")
-                    acc_xact_r = dbhelper.select("xact", where="uuid='%s'" % x_r["to_xact"])[0]
+                    acc_xact_r = select_by("xact", "uuid", x_r["to_xact"])[0]
                     make_xact(etree, x, "transactionTo", acc_xact_r)
                 else:
                     make_portfolio(etree, x, x_r["from_acc"])
-                    port_xact_r = dbhelper.select("xact", where="uuid='%s'" % x_r["from_xact"])[0]
+                    port_xact_r = select_by("xact", "uuid", x_r["from_xact"])[0]
                     make_xact(etree, x, "portfolioTransaction", port_xact_r)
 
-                    acc_r = dbhelper.select("account", where="uuid='%s'" % x_r["to_acc"])[0]
+                    acc_r = select_by("account", "uuid", x_r["to_acc"])[0]
                     make_account(etree, x, acc_r)
-                    acc_xact_r = dbhelper.select("xact", where="uuid='%s'" % x_r["to_xact"])[0]
+                    acc_xact_r = select_by("xact", "uuid", x_r["to_xact"])[0]
                     make_xact(etree, x, "accountTransaction", acc_xact_r)
                 x.wr_end()
 
-            make_prop(xact, xact_r, "shares")
-            make_prop(xact, xact_r, "note")
-            make_prop(xact, xact_r, "source")
+            emit_xact_mid(xact, xact_r)
 
-            unit_rows = dbhelper.select("xact_unit", where="xact='%s'" % xact_r["uuid"])
+            unit_rows = select_by("xact_unit", "xact", xact_r["uuid"])
             if unit_rows:
                 units = ET.SubElement(xact, "units")
                 for unit_r in unit_rows:
@@ -279,14 +578,18 @@ def make_xact(etree, pel, tag, xact_r):
                     u.wr_end()
                 units.wr_end()
 
-            make_prop(xact, xact_r, "updatedAt")
-            make_prop(xact, xact_r, "type")
+            emit_xact_tail(xact, xact_r)
 
             xact.wr_end()
 
 
 def make_xacts(etree, pel, acc_uuid):
-        for xact_r in dbhelper.select("xact", where="account='%s'" % acc_uuid, order="_order"):
+        if prefetcher is not None:
+            xacts = prefetcher.get("xact", "account", acc_uuid)
+        else:
+            # There may be lots of transactions, don't load them all at once.
+            xacts = dbhelper.iter_query("SELECT * FROM xact WHERE account=? ORDER BY _order", (acc_uuid,), table="xact")
+        for xact_r in xacts:
             tag = {"account": "account-transaction", "portfolio": "portfolio-transaction"}[xact_r["acctype"]]
             make_xact(etree, pel, tag, xact_r)
 
@@ -296,22 +599,19 @@ def make_portfolio(etree, pel, uuid, el_name="portfolio"):
         if try_ref(etree, el, uuid):
             return
         add_xmlid(el, uuid)
-        output_els[uuid] = el
-        port_r = dbhelper.select("account", where="uuid='%s'" % uuid)[0]
-        make_prop(el, port_r, "uuid")
-        make_prop(el, port_r, "name")
-        make_prop(el, port_r, "isRetired", conv=as_bool)
-        refacc_r = dbhelper.select("account", where="uuid='%s'" % port_r["referenceAccount"])[0]
+        port_r = select_by("account", "uuid", uuid)[0]
+        emit_portfolio_head(el, port_r)
+        refacc_r = select_by("account", "uuid", port_r["referenceAccount"])[0]
         make_account(etree, el, refacc_r, el_name="referenceAccount")
 
         xacts = ET.SubElement(el, "transactions")
         make_xacts(etree, xacts, port_r["uuid"])
         xacts.wr_end()
 
-        attr_rows = dbhelper.select("account_attr", where="account='%s'" % port_r["uuid"], order="seq")
+        attr_rows = select_by("account_attr", "account", port_r["uuid"], order="seq")
         make_attributes(el, attr_rows)
 
-        make_prop(el, port_r, "updatedAt")
+        emit_portfolio_tail(el, port_r)
         el.wr_end()
 
 
@@ -320,163 +620,213 @@ def make_account(etree, pel, acc_r, el_name="account"):
         if try_ref(etree, acc, acc_r["uuid"]):
             return
         add_xmlid(acc, acc_r["uuid"])
-        output_els[acc_r["uuid"]] = acc
-        make_prop(acc, acc_r, "uuid")
-        make_prop(acc, acc_r, "name")
-        make_prop(acc, acc_r, "currencyCode", "currency")
-        make_prop(acc, acc_r, "note")
-        make_prop(acc, acc_r, "isRetired", conv=as_bool)
+        emit_account_head(acc, acc_r)
 
         xacts = ET.SubElement(acc, "transactions")
         make_xacts(etree, xacts, acc_r["uuid"])
         xacts.wr_end()
 
-        attr_rows = dbhelper.select("account_attr", where="account='%s'" % acc_r["uuid"], order="seq")
+        attr_rows = select_by("account_attr", "account", acc_r["uuid"], order="seq")
         make_attributes(acc, attr_rows)
 
-        make_prop(acc, acc_r, "updatedAt")
+        emit_account_tail(acc, acc_r)
         acc.wr_end()
 
 
+QUOTE_RE = re.compile("[&<>\"']")
+QUOTE_TABLE = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "'": "&apos;",
+})
+
+
 def quote_text(s):
-    pats = (
-        ("&", "&amp;"),
-        ("<", "&lt;"),
-        (">", "&gt;"),
-        ('"', "&quot;"),
-        ("'", "&apos;"),
-    )
-    for p, r in pats:
-        s = s.replace(p, r)
-    return s
+    # Most strings don't need quoting, check that quickly.
+    if QUOTE_RE.search(s) is None:
+        return s
+    return s.translate(QUOTE_TABLE)
 
 
 def make_taxonomy_level(etree, pel, level_r):
         tag = "root" if level_r["parent"] is None else "classification"
         level = ET_SubElementWId(pel, tag, level_r["uuid"])
-        output_els[level_r["uuid"]] = level
-        make_prop(level, level_r, "id", "uuid")
-        make_prop(level, level_r, "name")
-        make_prop(level, level_r, "color")
+        emit_taxonomy_category_head(level, level_r)
 
         if level_r["parent"]:
             p = ET.SubElement(level, "parent")
             assert try_ref(etree, p, level_r["parent"])
 
         chds = ET.SubElement(level, "children")
-        for e_r in dbhelper.select("taxonomy_category", where="parent='%s'" % level_r["uuid"]):
+        for e_r in select_by("taxonomy_category", "parent", level_r["uuid"]):
             make_taxonomy_level(etree, chds, e_r)
         chds.wr_end()
 
         assgn = ET.SubElement(level, "assignments")
-        for a_r in dbhelper.select("taxonomy_assignment", where="category='%s'" % level_r["uuid"]):
+        for a_r in select_by("taxonomy_assignment", "category", level_r["uuid"]):
+            if sec_filter is not None and a_r["item"] not in sec_filter and a_r["item"] not in acc_filter:
+                continue
             a = ET.SubElement(assgn, "assignment")
             iv = ET.SubElement(a, "investmentVehicle")
             iv.set("class", a_r["item_type"])
             assert try_ref(etree, iv, a_r["item"])
-            make_prop(a, a_r, "weight")
-            make_prop(a, a_r, "rank")
+            emit_taxonomy_assignment(a, a_r)
 
-            data_rows =  dbhelper.select("taxonomy_assignment_data", where="assignment=%d" % a_r["_id"])
+            data_rows =  select_by("taxonomy_assignment_data", "assignment", a_r["_id"])
             make_data_entries(a, data_rows)
             a.wr_end()
         assgn.wr_end()
 
-        make_prop(level, level_r, "weight")
-        make_prop(level, level_r, "rank")
+        emit_taxonomy_category_tail(level, level_r)
 
-        data_rows = dbhelper.select("taxonomy_data", where="category='%s'" % level_r["uuid"])
+        data_rows = select_by("taxonomy_data", "category", level_r["uuid"])
         make_data_entries(level, data_rows)
         level.wr_end()
 
 
+def make_security(securities, sec_r):
+    sec = ET_SubElementWId(securities, "security", sec_r["uuid"])
+    emit_security_head(sec, sec_r)
+
+    make_prices(sec, sec_r)
+
+    emit_security_feed(sec, sec_r)
+
+    # Can be 0 or 1
+    for latest_r in select_by("latest_price", "security", sec_r["uuid"]):
+        latest = ET.SubElement(sec, "latest")
+        emit_latest_price(latest, latest_r)
+        latest.wr_end()
+
+    attr_rows = select_by("security_attr", "security", sec_r["uuid"], order="seq")
+    make_attributes(sec, attr_rows)
+
+    events = ET.SubElement(sec, "events")
+    for event_r in select_by("security_event", "security", sec_r["uuid"], order=events_order()):
+        event = ET.SubElement(events, "event")
+        emit_security_event(event, event_r)
+        event.wr_end()
+    events.wr_end()
+
+    for prop_r in select_by("security_prop", "security", sec_r["uuid"], order="seq"):
+        p = ET.SubElement(sec, "property")
+        p.set("type", prop_r["type"])
+        p.set("name", prop_r["name"])
+        p.text = prop_r["value"]
+
+    emit_security_tail(sec, sec_r)
+    sec.wr_end()
+
+
+# Parallel export (--jobs): security blocks (the bulk of the output, due to
+# prices) don't depend on each other, and each uses exactly one xmlid, so
+# they can be rendered in chunks by worker processes, each starting with
+# known xmlid, and concatenated in order.
+
+def _init_worker(_args, _sec_filter):
+    global args, sec_filter
+    args = _args
+    sec_filter = _sec_filter
+    dbhelper.init(args.dbtype, args.db, readonly=True)
+    # Own statistics (not the one inherited from the parent on fork),
+    # passed to the parent with each chunk.
+    dbhelper.stats = Stats() if args.stats or args.stats_json else None
+
+
+# Render securities with _id's in the given range, return UTF-8 output and
+# statistics (rows, times) of rendering it (or None).
+def _make_securities_chunk(chunk):
+    global out, price_stream, xml_id
+    start_xml_id, min_id, max_id = chunk
+    buf = io.BytesIO()
+    out = BufferedOut(buf)
+    xml_id = start_xml_id
+    sec_rows = dbhelper.query("SELECT * FROM security WHERE _id BETWEEN ? AND ? ORDER BY _id", (min_id, max_id), "security")
+    ids = None
+    if sec_filter is not None:
+        sec_rows = [r for r in sec_rows if r["uuid"] in sec_filter]
+        ids = [r["_id"] for r in sec_rows]
+    price_stream = PriceStream(min_id, max_id, ids)
+    # Stub for the already started <securities>
+    securities = ET.Element("securities")
+    securities._indent = 1
+    securities.start_written = True
+    for sec_r in sec_rows:
+        make_security(securities, sec_r)
+    out.flush()
+    chunk_stats = None
+    stats = dbhelper.stats
+    if stats is not None:
+        chunk_stats = (dict(stats.rows), dict(stats.times))
+        stats.rows.clear()
+        stats.times.clear()
+    return buf.getvalue(), chunk_stats
+
+
+def make_securities_parallel(securities, sec_rows):
+    global xml_id
+    securities.wr_start()
+    # Several chunks per worker, to balance the load.
+    chunk_size = max(1, len(sec_rows) // (args.jobs * 4))
+    chunks = []
+    for i in range(0, len(sec_rows), chunk_size):
+        rows = sec_rows[i:i + chunk_size]
+        chunks.append((xml_id + i, rows[0]["_id"], rows[-1]["_id"]))
+
+    with multiprocessing.Pool(args.jobs, _init_worker, (args, sec_filter)) as pool:
+        for data, chunk_stats in pool.imap(_make_securities_chunk, chunks):
+            out.write_raw(data)
+            if chunk_stats is not None:
+                dbhelper.stats.merge(*chunk_stats)
+
+    # Allocate xmlids the same way as workers did.
+    for sec_r in sec_rows:
+        xml_id += 1
+        uuid2xmlid[pack_uuid(sec_r["uuid"])] = xml_id
+
 def main():
-    global out
-    out = sys.stdout
+    global out, prefetcher, price_stream
     if args.xml_file:
-        out = open(args.xml_file, "w", encoding="utf-8", newline="\n")
+        out = BufferedOut(fileio.open_output(args.xml_file, "zip" if args.zip else None))
+    else:
+        out = BufferedOut(sys.stdout.buffer)
+
+    if args.prefetch:
+        prefetcher = Prefetcher()
 
     root = ET.Element("client")
     add_xmlid(root)
     etree = None
     for n in ["version", "baseCurrency"]:
-        row = dbhelper.select("property", where="name='%s'" % n)[0]
+        row = dbhelper.select_by("property", ("name",), (n,))[0]
         ET.SubElement(root, n).text = row["value"]
 
     securities = ET.SubElement(root, "securities")
 
-    for i, sec_r in enumerate(dbhelper.select("security")):
-    #    print(dict(sec_r))
-        sec_map[sec_r["uuid"]] = i
-        sec = ET_SubElementWId(securities, "security", sec_r["uuid"])
-        output_els[sec_r["uuid"]] = sec
-        make_prop(sec, sec_r, "uuid")
-        make_prop(sec, sec_r, "onlineId")
-        make_prop(sec, sec_r, "name")
-        make_prop(sec, sec_r, "currencyCode", "currency")
-        make_prop(sec, sec_r, "targetCurrencyCode", "targetCurrency")
-        make_prop(sec, sec_r, "note")
-        make_prop(sec, sec_r, "isin")
-        make_prop(sec, sec_r, "tickerSymbol")
-        make_prop(sec, sec_r, "calendar")
-        make_prop(sec, sec_r, "wkn")
-        make_prop(sec, sec_r, "feedTickerSymbol")
-        make_prop(sec, sec_r, "feed")
-        make_prop(sec, sec_r, "feedURL")
-
-        prices = ET.SubElement(sec, "prices")
-        for price_r in dbhelper.select("price", where="security='%s'" % sec_r["uuid"]):
-            p = ET.SubElement(prices, "price")
-            p.set("t", price_r["tstamp"])
-            p.set("v", str(price_r["value"]))
-            p.wr_nb()
-        prices.wr_end()
-
-        make_prop(sec, sec_r, "latestFeed")
-        make_prop(sec, sec_r, "latestFeedURL")
-
-        # Can be 0 or 1
-        for latest_r in dbhelper.select("latest_price", where="security='%s'" % sec_r["uuid"]):
-            latest = ET.SubElement(sec, "latest")
-            latest.set("t", latest_r["tstamp"])
-            latest.set("v", str(latest_r["value"]))
-            make_prop(latest, latest_r, "high")
-            make_prop(latest, latest_r, "low")
-            make_prop(latest, latest_r, "volume")
-            latest.wr_end()
-
-        attr_rows = dbhelper.select("security_attr", where="security='%s'" % sec_r["uuid"], order="seq")
-        make_attributes(sec, attr_rows)
-
-        events = ET.SubElement(sec, "events")
-        order_args = {}
-        if args.sort_events:
-            order_args = {"order": "date, details"}
-        for event_r in dbhelper.select("security_event", where="security='%s'" % sec_r["uuid"], **order_args):
-            event = ET.SubElement(events, "event")
-            make_prop(event, event_r, "date")
-            make_prop(event, event_r, "type")
-            make_prop(event, event_r, "details")
-            event.wr_end()
-        events.wr_end()
-
-        for prop_r in dbhelper.select("security_prop", where="security='%s'" % sec_r["uuid"], order="seq"):
-            p = ET.SubElement(sec, "property")
-            p.set("type", prop_r["type"])
-            p.set("name", prop_r["name"])
-            p.text = prop_r["value"]
-
-        make_prop(sec, sec_r, "isRetired", conv=as_bool)
-        make_prop(sec, sec_r, "updatedAt")
-        sec.wr_end()
+    compute_filters()
+    sec_rows = dbhelper.select("security", order="_id")
+    ids = None
+    if sec_filter is not None:
+        sec_rows = [r for r in sec_rows if r["uuid"] in sec_filter]
+        ids = [r["_id"] for r in sec_rows]
+    if args.jobs > 1 and sec_rows:
+        make_securities_parallel(securities, sec_rows)
+    else:
+        price_stream = PriceStream(ids=ids)
+        for sec_r in sec_rows:
+            make_security(securities, sec_r)
     securities.wr_end()
 
     watchlists = ET.SubElement(root, "watchlists")
     for wlist_r in dbhelper.select("watchlist", order="_order"):
         wlist = ET_SubElementWId(watchlists, "watchlist")
-        make_prop(wlist, wlist_r, "name")
+        emit_watchlist(wlist, wlist_r)
         secs = ET.SubElement(wlist, "securities")
-        for wlist_sec_r in dbhelper.select("watchlist_security", where="list=%d" % wlist_r["_id"]):
+        for wlist_sec_r in select_by("watchlist_security", "list", wlist_r["_id"]):
+            if sec_filter is not None and wlist_sec_r["security"] not in sec_filter:
+                continue
             s = ET.SubElement(secs, "security")
             s.set("reference", security_ref(wlist_sec_r["security"]))
             s.wr_nb()
@@ -486,11 +836,15 @@ def main():
 
     accounts = ET.SubElement(root, "accounts")
     for acc_r in dbhelper.select("account", where="type='account'", order="_order"):
+        if acc_filter is not None and acc_r["uuid"] not in acc_filter:
+            continue
         make_account(etree, accounts, acc_r)
     accounts.wr_end()
 
     portfolios = ET.SubElement(root, "portfolios")
     for acc_r in dbhelper.select("account", where="type='portfolio'", order="_order"):
+        if acc_filter is not None and acc_r["uuid"] not in acc_filter:
+            continue
         make_portfolio(etree, portfolios, acc_r["uuid"])
     portfolios.wr_end()
 
@@ -500,15 +854,14 @@ def main():
     taxonomies = ET.SubElement(root, "taxonomies")
     for taxon_r in dbhelper.select("taxonomy"):
         taxon = ET.SubElement(taxonomies, "taxonomy")
-        make_prop(taxon, taxon_r, "id", "uuid")
-        make_prop(taxon, taxon_r, "name")
-        taxon_dim_rows =  dbhelper.select("taxonomy_data", where="taxonomy='%s' AND category IS NULL AND name='dimension'" % taxon_r["uuid"])
+        emit_taxonomy(taxon, taxon_r)
+        taxon_dim_rows = select_taxonomy_dimensions(taxon_r["uuid"])
         if taxon_dim_rows:
             el = ET.SubElement(taxon, "dimensions")
             for taxon_dim_r in taxon_dim_rows:
                 ET.SubElement(el, "string").text = taxon_dim_r["value"]
             el.wr_end()
-        e_r = dbhelper.select("taxonomy_category", where="uuid='%s'" % taxon_r["root"])[0]
+        e_r = select_by("taxonomy_category", "uuid", taxon_r["root"])[0]
         make_taxonomy_level(etree, taxon, e_r)
         taxon.wr_end()
     taxonomies.wr_end()
@@ -517,18 +870,17 @@ def main():
     dashboards = ET.SubElement(root, "dashboards")
     for dashb_r in dbhelper.select("dashboard"):
         dashb = ET.SubElement(dashboards, "dashboard")
-        dashb.set("name", dashb_r["name"])
-        make_prop(dashb, dashb_r, "id")
+        emit_dashboard(dashb, dashb_r)
         make_configuration(dashb, json.loads(dashb_r["config_json"]))
         columns = ET.SubElement(dashb, "columns")
         for col_j in json.loads(dashb_r["columns_json"]):
             col = ET.SubElement(columns, "column")
-            make_prop(col, col_j, "weight")
+            emit_dashboard_column(col, col_j)
             widgets = ET.SubElement(col, "widgets")
             for wid_j in col_j["widgets"]:
                 wid = ET.SubElement(widgets, "widget")
                 wid.set("type", wid_j["type"])
-                make_prop(wid, wid_j, "label")
+                emit_dashboard_widget(wid, wid_j)
                 if "config" in wid_j:
                     make_configuration(wid, wid_j["config"])
                 wid.wr_end()
@@ -549,21 +901,14 @@ def main():
     bookmarks = ET.SubElement(settings, "bookmarks")
     for bmark_r in dbhelper.select("bookmark"):
         bmark = ET.SubElement(bookmarks, "bookmark")
-        make_prop(bmark, bmark_r, "label")
-        make_prop(bmark, bmark_r, "pattern")
+        emit_bookmark(bmark, bmark_r)
         bmark.wr_end()
     bookmarks.wr_end()
 
     attrtypes = ET.SubElement(settings, "attributeTypes")
     for attr_type_r in dbhelper.select("attribute_type"):
         attr_type = ET.SubElement(attrtypes, "attribute-type")
-        make_prop(attr_type, attr_type_r, "id")
-        make_prop(attr_type, attr_type_r, "name")
-        make_prop(attr_type, attr_type_r, "columnLabel")
-        make_prop(attr_type, attr_type_r, "source")
-        make_prop(attr_type, attr_type_r, "target")
-        make_prop(attr_type, attr_type_r, "type")
-        make_prop(attr_type, attr_type_r, "converterClass")
+        emit_attribute_type(attr_type, attr_type_r)
         prop_list = json.loads(attr_type_r["props_json"])
         if prop_list:
             props = ET.SubElement(attr_type, "properties")
@@ -579,14 +924,12 @@ def main():
     config_sets = ET.SubElement(settings, "configurationSets")
     for cset_r in dbhelper.select("config_set"):
         el = ET.SubElement(config_sets, "entry")
-        make_prop(el, cset_r, "string", "name")
+        emit_config_set(el, cset_r)
         el2 = ET.SubElement(el, "config-set")
         el3 = ET.SubElement(el2, "configurations")
-        for centry_r in dbhelper.select("config_entry", where="config_set=%d" % cset_r["_id"]):
+        for centry_r in select_by("config_entry", "config_set", cset_r["_id"]):
             centry = ET.SubElement(el3, "config")
-            make_prop(centry, centry_r, "uuid")
-            make_prop(centry, centry_r, "name")
-            make_prop(centry, centry_r, "data")
+            emit_config_entry(centry, centry_r)
             centry.wr_end()
         el3.wr_end()
         el2.wr_end()
@@ -596,20 +939,36 @@ def main():
     settings.wr_end()
 
     root.wr_end()
+    out.close()
 
 
 if __name__ == "__main__":
     argp = argparse.ArgumentParser(description="Export Sqlite DB to PortfolioPerformance XML file")
     argp.add_argument("db", help="input DB (filename/connect string)")
-    argp.add_argument("xml_file", nargs="?", help="output XML file (stdout if not provided)")
+    argp.add_argument("xml_file", nargs="?", help="output XML file (stdout if not provided), compressed if name ends with .gz, .xz, .bz2, .zst or .zip")
     argp.add_argument("--dbtype", choices=("sqlite", "pgsql"), default="sqlite", help="select database type")
+    argp.add_argument("--zip", action="store_true", help="write XML file in ZIP container, as PP does for compressed XML files (e.g. *.portfolio), regardless of file name")
     argp.add_argument("--sort-events", action="store_true", help="sort events by date (then description)")
+    argp.add_argument("--prefetch", action="store_true", help="load child tables at once instead of querying them per row (faster, uses more memory)")
+    argp.add_argument("--securities", action="append", help="export only these securities (uuids, ISINs, ticker symbols or names; comma-separated, may be repeated), plus ones used by exported accounts")
+    argp.add_argument("--accounts", action="append", help="export only these accounts/portfolios (uuids or names; comma-separated, may be repeated), plus ones they reference (with --securities only, no accounts are exported)")
+    argp.add_argument("--prices-since", metavar="DATE", help="export only historical prices since this date (YYYY-MM-DD)")
+    argp.add_argument("--no-prices", action="store_true", help="don't export historical prices")
+    argp.add_argument("--jobs", type=int, default=1, help="render securities (with prices) in this number of parallel processes (default: %(default)s)")
     argp.add_argument("--debug", action="store_true", help="enable debug logging")
+    argp.add_argument("--stats", action="store_true", help="print statistics (rows per table, time per phase, peak memory) to stderr at the end")
+    argp.add_argument("--stats-json", action="store_true", help="print statistics as JSON (implies --stats)")
     argp.add_argument("--version", action="version", version="%(prog)s " + __version__)
     args = argp.parse_args()
+    if args.zip and not args.xml_file:
+        argp.error("--zip requires output file")
 
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
 
+    if args.stats or args.stats_json:
+        dbhelper.stats = Stats()
     dbhelper.init(args.dbtype, args.db)
     main()
+    if dbhelper.stats is not None:
+        dbhelper.stats.report(sys.stderr, "json" if args.stats_json else "text", "xml_write")
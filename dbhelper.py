@@ -1,4 +1,9 @@
+import re
 import logging
+import itertools
+import time
+import os.path
+import urllib.parse
 import sqlite3
 
 
@@ -13,37 +18,116 @@ param_mark = None
 
 sqllog = None
 
+# If non-zero, insert() doesn't execute statements immediately, but buffers
+# rows and executes them in batches of (up to) this size using executemany().
+batch_size = 0
+# table -> [(table, field names, or_replace), sql, [values, ...], padded].
+# Rows for a table are kept in a single run with the same column set (and
+# thus the same SQL), so the order of rows within a table is preserved
+# (important for _id's). To keep runs long, buffered rows are padded to all
+# columns of the table (see full_columns()), padded is True for such runs.
+pending = {}
+# table -> ([(column, default), ...], set of column names), see full_columns()
+full_columns_cache = {}
+# Tables for which buffered rows are written using COPY on pgsql, which is
+# much faster than (even batched) INSERTs for bulk data.
+copy_tables = set()
+# (table, field names, or_replace) -> INSERT statement
+insert_sql_cache = {}
+# To generate unique names for server-side cursors
+cursor_ids = itertools.count()
+# stats.Stats instance to account DB execution time and row counts to, if any.
+stats = None
+# SQL -> cursor, for statements executed repeatedly with different
+# parameters. Such statements are prepared once: sqlite3 caches prepared
+# statements by SQL text, psycopg prepares them on the server after a few
+# executions.
+cursor_cache = {}
+# (table, key columns, order) -> SELECT statement
+select_sql_cache = {}
 
-def init(_dbtype, dbname):
+
+# Column definition line in a schema file (see schema_column_names()).
+COLUMN_DEF_RE = re.compile(r"^\s*([A-Za-z_]\w*)\s+[A-Z]", re.M)
+
+
+# Pragmas for bulk loading data into SQLite, trading durability during the
+# load (the database may be corrupted if the system crashes) for speed.
+SQLITE_FAST_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    # In KiB, if negative
+    "cache_size": -1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+# If in_memory is True (sqlite only), the database is loaded into memory
+# and all changes are made there, until publish() is called.
+def init(_dbtype, dbname, readonly=False, in_memory=False):
     global dbtype, param_mark
     dbtype = _dbtype
 
     if dbtype == "pgsql":
         param_mark = "%s"
-        init_pgsql(dbname)
+        init_pgsql(dbname, readonly)
     else:
         param_mark = "?"
-        init_sqlite(dbname)
+        init_sqlite(dbname, readonly, in_memory)
 
 
-def init_sqlite(dbname):
+def init_sqlite(dbname, readonly=False, in_memory=False):
     global db
-    db = sqlite3.connect(dbname)
+    if readonly:
+        dbname = "file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(dbname))
+    # Connection may be used by a writer thread (but never concurrently).
+    if in_memory:
+        if not os.path.exists(dbname):
+            raise ValueError("Database doesn't exist (create it with ppxml2db_init.py): %s" % dbname)
+        db = sqlite3.connect(":memory:", check_same_thread=False)
+        src = sqlite3.connect(dbname)
+        src.backup(db)
+        src.close()
+    else:
+        db = sqlite3.connect(dbname, check_same_thread=False, uri=readonly)
     db.row_factory = sqlite3.Row
     if LOG_SQL_TO_FILE:
         global sqllog
         sqllog = open(dbname + ".sql", "w")
 
 
-def init_pgsql(dbname):
+def init_pgsql(dbname, readonly=False):
     import psycopg
     global db
     db = psycopg.connect(dbname, row_factory=psycopg.rows.namedtuple_row)
+    db.read_only = readonly
     execute_dml("SET session_replication_role = 'replica'")
     execute_dml("BEGIN")
 
 
-def execute_dml(sql, values = (), returning=None):
+# Call a DB API function, accounting its execution time to stats.
+def _timed(func, *args):
+    if stats is None:
+        return func(*args)
+    t = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        stats.add_time("db", time.perf_counter() - t)
+
+
+# Get cursor for a statement executed repeatedly (see cursor_cache).
+def cached_cursor(sql):
+    cursor = cursor_cache.get(sql)
+    if cursor is None:
+        cursor = cursor_cache[sql] = db.cursor()
+    return cursor
+
+
+# If cached is True, the statement is expected to be executed repeatedly,
+# and uses a cached cursor.
+def execute_dml(sql, values = (), returning=None, cached=False):
+    flush()
     if returning:
         sql += " RETURNING " + returning
     if dbtype == "pgsql":
@@ -51,44 +135,130 @@ def execute_dml(sql, values = (), returning=None):
     if LOG_SQL_TO_FILE:
         sqllog.write("%s %s\n" % (sql, values))
         return
-    cursor = db.cursor()
-    log.debug(sql + " " + str(values))
-    cursor.execute(sql, values)
+    cursor = cached_cursor(sql) if cached else db.cursor()
+    log.debug("%s %s", sql, values)
+    _timed(cursor.execute, sql, values)
+    if returning:
+        # Also completes the statement (for a cached cursor, it stays
+        # active otherwise).
+        return cursor.fetchone()[0]
+    if dbtype != "pgsql":
+        return cursor.lastrowid
+
+
+def executemany_dml(sql, values_list, cached=False):
     if dbtype == "pgsql":
-        if returning:
-            return cursor.fetchone()[0]
+        sql = sql.replace("?", "%s")
+    if LOG_SQL_TO_FILE:
+        for values in values_list:
+            sqllog.write("%s %s\n" % (sql, values))
+        return
+    cursor = cached_cursor(sql) if cached else db.cursor()
+    log.debug("%s [%d rows]", sql, len(values_list))
+    _timed(cursor.executemany, sql, values_list)
+
+
+def copy_rows(table, field_names, values_list):
+    sql = "COPY %s (%s) FROM STDIN" % (table, ", ".join(field_names))
+    if LOG_SQL_TO_FILE:
+        for values in values_list:
+            sqllog.write("%s %s\n" % (sql, values))
+        return
+    cursor = db.cursor()
+    log.debug("%s [%d rows]", sql, len(values_list))
+    _timed(_copy, cursor, sql, values_list)
+
+
+def _copy(cursor, sql, values_list):
+    with cursor.copy(sql) as copy:
+        for values in values_list:
+            copy.write_row(values)
+
+
+def _flush_batch(batch):
+    (table, field_names, or_replace), sql, values_list, padded = batch
+    # COPY is used only for runs of rows padded to the full column list
+    # (see insert()), so a table is loaded with long COPYs of a fixed
+    # shape. A run of other rows (e.g. with explicit _id) is short, and
+    # would be slower with a COPY round trip.
+    if dbtype == "pgsql" and padded and table in copy_tables and not or_replace:
+        copy_rows(table, field_names, values_list)
     else:
-        return cursor.lastrowid
+        executemany_dml(sql, values_list, cached=True)
+
+
+# Execute pending buffered inserts (for all tables, or just the given one).
+def flush(table=None):
+    if table is not None:
+        batch = pending.pop(table, None)
+        if batch is not None:
+            _flush_batch(batch)
+        return
+    while pending:
+        _flush_batch(pending.pop(next(iter(pending))))
 
 
 def executescript(sql):
+    flush()
     cursor = db.cursor()
     log.debug(sql)
     if dbtype == "pgsql":
-        cursor.execute(sql)
+        _timed(cursor.execute, sql)
     else:
-        cursor.executescript(sql)
+        _timed(cursor.executescript, sql)
 
 
+# If batching is enabled (batch_size is set) and no returning value is
+# requested, the row is buffered and None is returned.
 def insert(table, fields=None, or_replace=False, returning=None, **kw):
-    repl_clause = ""
-    if or_replace:
-        repl_clause = " OR REPLACE"
     if fields is None:
         fields = kw
-    field_names = []
-    field_vals = []
-    qmarks = []
-    for k, v in fields.items():
-        field_names.append(k)
-        field_vals.append(v)
-        qmarks.append(param_mark)
-    sql = "INSERT%s INTO %s(%s) VALUES (%s)" % (repl_clause, table, ", ".join(field_names), ", ".join(qmarks))
-    id = execute_dml(sql, field_vals, returning)
+    buffered = batch_size and not returning
+    padded = False
+    if buffered:
+        # Optional columns vary from row to row, and each column set would
+        # start a new run (flushing the previous one), so rows are padded
+        # with the declared defaults, and all use the same statement. Rows
+        # with explicit _id are left as is (as are rows for a table which
+        # doesn't exist, to fail on insert).
+        cols, names = full_columns(table)
+        if "_id" not in fields and names:
+            if not fields.keys() <= names:
+                # Would be silently dropped by padding otherwise.
+                raise ValueError("Unknown columns of table %s: %s" % (table, ", ".join(sorted(fields.keys() - names))))
+            fields = {name: fields.get(name, default) for name, default in cols}
+            padded = True
+    key = (table, tuple(fields), or_replace)
+    sql = insert_sql_cache.get(key)
+    if sql is None:
+        repl_clause = ""
+        if or_replace:
+            repl_clause = " OR REPLACE"
+        qmarks = ", ".join([param_mark] * len(fields))
+        sql = "INSERT%s INTO %s(%s) VALUES (%s)" % (repl_clause, table, ", ".join(fields), qmarks)
+        insert_sql_cache[key] = sql
+    field_vals = tuple(fields.values())
+    if stats is not None:
+        stats.count(table)
+
+    if buffered:
+        batch = pending.get(table)
+        if batch is not None and batch[1] != sql:
+            flush(table)
+            batch = None
+        if batch is None:
+            batch = pending[table] = [key, sql, [], padded]
+        batch[2].append(field_vals)
+        if len(batch[2]) >= batch_size:
+            flush(table)
+        return None
+
+    id = execute_dml(sql, field_vals, returning, cached=True)
     return id
 
 
 def select(table, where=None, order=None):
+    flush()
     cursor = db.cursor()
     if where is None:
         where = ""
@@ -101,11 +271,200 @@ def select(table, where=None, order=None):
     sql = "SELECT * FROM %s%s%s" % (table, where, order)
     if LOG_SQL_TO_FILE:
         sqllog.write("%s\n" % sql)
-    cursor.execute(sql)
     log.debug(sql)
+    rows = _timed(_execute_fetchall, cursor, sql)
+    if stats is not None:
+        stats.count(table, len(rows))
+    return rows
+
+
+def _execute_fetchall(cursor, sql, values=()):
+    cursor.execute(sql, values)
     return cursor.fetchall()
 
 
+# Execute a parameterized query repeatedly executed (with different
+# parameters), using a cached cursor, and return all its rows. Fetched
+# rows are accounted to the given table in stats.
+def query(sql, values=(), table=None):
+    flush()
+    if dbtype == "pgsql":
+        sql = sql.replace("?", "%s")
+    if LOG_SQL_TO_FILE:
+        sqllog.write("%s %s\n" % (sql, values))
+    cursor = cached_cursor(sql)
+    log.debug("%s %s", sql, values)
+    rows = _timed(_execute_fetchall, cursor, sql, values)
+    if stats is not None and table is not None:
+        stats.count(table, len(rows))
+    return rows
+
+
+# Select rows of a table with the given key columns equal to the values,
+# using a statement cached by table and columns. This is the way to query
+# rows per some other row.
+def select_by(table, key_cols, values, order=None):
+    cache_key = (table, key_cols, order)
+    sql = select_sql_cache.get(cache_key)
+    if sql is None:
+        sql = "SELECT * FROM %s WHERE %s" % (table, " AND ".join("%s=?" % c for c in key_cols))
+        if order is not None:
+            sql += " ORDER BY " + order
+        select_sql_cache[cache_key] = sql
+    return query(sql, values, table)
+
+
+def _parse_default(val):
+    if val is None:
+        return None
+    # Strip pgsql type cast, e.g. ''::character varying
+    val = val.split("::", 1)[0]
+    if val.startswith("'"):
+        return val[1:-1].replace("''", "'")
+    if val.upper() == "NULL":
+        return None
+    try:
+        return int(val)
+    except ValueError:
+        # Function call or similar (e.g. nextval() for pgsql SERIAL)
+        return None
+
+
+# Return list of (column name, default value) of a table.
+def table_columns(table):
+    flush()
+    cursor = db.cursor()
+    if dbtype == "pgsql":
+        cursor.execute(
+            "SELECT column_name, column_default FROM information_schema.columns"
+            " WHERE table_name=%s AND table_schema=current_schema() ORDER BY ordinal_position",
+            (table,)
+        )
+        # pgsql folds unquoted identifiers to lower case, so return names
+        # as spelled in the schema, matching field names used in the code.
+        spelling = schema_column_names(table)
+        rows = [(spelling.get(name, name), default) for name, default in cursor.fetchall()]
+    else:
+        cursor.execute("PRAGMA table_info(%s)" % table)
+        rows = [(r[1], r[4]) for r in cursor.fetchall()]
+    return [(name, _parse_default(default)) for name, default in rows]
+
+
+# Lower-cased column name -> column name as spelled in the table's schema
+# file (empty if there's none).
+def schema_column_names(table):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), table + ".sql")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        sql = f.read()
+    return {name.lower(): name for name in COLUMN_DEF_RE.findall(sql)}
+
+
+# Columns of a table (with their default values) which rows can be padded
+# to, and set of their names. _id is assigned by the DB, so not included.
+def full_columns(table):
+    res = full_columns_cache.get(table)
+    if res is None:
+        cols = [(name, default) for name, default in table_columns(table) if name != "_id"]
+        res = full_columns_cache[table] = (cols, {name for name, _ in cols})
+    return res
+
+
+# Execute a query and iterate over its results lazily, fetching them in
+# chunks, so large results are never materialized as a whole. Fetched rows
+# are accounted to the given table in stats.
+def iter_query(sql, values=(), fetch_size=1000, table=None):
+    flush()
+    if dbtype == "pgsql":
+        sql = sql.replace("?", "%s")
+        # Client-side cursors in psycopg fetch the whole result at once,
+        # a server-side (named) one is needed for streaming.
+        cursor = db.cursor(name="iter_query_%d" % next(cursor_ids))
+    else:
+        cursor = db.cursor()
+    if LOG_SQL_TO_FILE:
+        sqllog.write("%s %s\n" % (sql, values))
+    log.debug("%s %s", sql, values)
+    _timed(cursor.execute, sql, values)
+    while True:
+        rows = _timed(cursor.fetchmany, fetch_size)
+        if not rows:
+            break
+        if stats is not None and table is not None:
+            stats.count(table, len(rows))
+        yield from rows
+    cursor.close()
+
+
+# Set SQLite pragmas, returning their previous values (so they can be
+# restored by calling this again). Should be called outside of transaction.
+def set_pragmas(pragmas):
+    old = {}
+    for name, val in pragmas.items():
+        old[name] = db.execute("PRAGMA %s" % name).fetchone()[0]
+        log.debug("PRAGMA %s = %s", name, val)
+        db.execute("PRAGMA %s = %s" % (name, val))
+    return old
+
+
+# Copy (committed) in-memory database (see init()) to the given file,
+# atomically replacing it: it's written to a temporary file first, which
+# is then renamed, so readers see either old or new database, complete.
+def publish(dbname):
+    release_wal(dbname)
+    tmpname = dbname + ".tmp"
+    if os.path.exists(tmpname):
+        os.remove(tmpname)
+    log.debug("Publishing database to %s", dbname)
+    dst = sqlite3.connect(tmpname)
+    _timed(db.backup, dst)
+    # Readers may have the database open, don't leave it in WAL mode, as
+    # its -wal file would then be shared by old and new database files.
+    dst.execute("PRAGMA journal_mode = DELETE")
+    dst.close()
+    os.replace(tmpname, dbname)
+
+
+# Prepare sqlite database file to be replaced with another one. If it's in
+# WAL mode, its -wal and -shm files would stay after the replacement, and
+# frames in the -wal file could then be applied to the new database. So
+# committed frames are written back to the database, which is switched to
+# rollback journal mode (which can be done only if no other connection
+# uses it), and any remaining -wal/-shm files are removed.
+def release_wal(dbname):
+    if os.path.exists(dbname):
+        conn = sqlite3.connect(dbname)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("PRAGMA journal_mode = DELETE")
+        except sqlite3.OperationalError as e:
+            raise ValueError("Can't take database out of WAL mode (%s), is it in use by other programs?: %s" % (e, dbname))
+        finally:
+            conn.close()
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(dbname + suffix):
+            log.debug("Removing %s", dbname + suffix)
+            os.remove(dbname + suffix)
+
+
+# Start transaction explicitly. Needed for sqlite to run DDL statements
+# (which don't start one implicitly) in the same transaction as following
+# DML. pgsql connection is always in transaction.
+def begin():
+    flush()
+    if dbtype != "pgsql" and not db.in_transaction:
+        log.debug("BEGIN")
+        db.execute("BEGIN")
+
+
 def commit():
+    flush()
     log.debug("COMMIT")
     db.commit()
+
+
+def rollback():
+    pending.clear()
+    log.debug("ROLLBACK")
+    db.rollback()
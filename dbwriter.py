@@ -0,0 +1,551 @@
+from collections import defaultdict
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+import dbhelper
+from compact import pack_uuid, unpack_uuid
+
+
+_log = logging.getLogger(__name__)
+
+
+# Writes rows produced by the importer to the database as is.
+class DBWriter:
+
+    # Tables which rows may have their _order updated by set_order().
+    ORDERED = ("account", "xact")
+
+    def __init__(self):
+        # table -> xmlid (int) -> uuid (packed) of inserted rows
+        self.xmlid2uuid = {table: {} for table in self.ORDERED}
+        # table -> uuid (packed) -> _order to set in finish()
+        self.orders = {table: {} for table in self.ORDERED}
+
+    def insert(self, table, fields, returning=None):
+        self.register(table, fields)
+        return dbhelper.insert(table, fields, returning=returning)
+
+    # Record a row as inserted (by this or previous run), without writing
+    # it.
+    def register(self, table, fields):
+        if table in self.xmlid2uuid:
+            self.xmlid2uuid[table][int(fields["_xmlid"])] = pack_uuid(fields["uuid"])
+
+    # Update _order of a previously inserted account/xact row, per position
+    # of a reference to it in the XML. Updates are collected and executed
+    # at once in finish() (by uuid, which is indexed, unlike _xmlid).
+    # References to a row not inserted yet (from within its own element)
+    # are ignored, its _order is set on insert.
+    def set_order(self, table, xmlid, orderno):
+        uuid = self.xmlid2uuid[table].get(int(xmlid))
+        if uuid is not None:
+            self.orders[table][uuid] = orderno
+
+    def finish(self):
+        dbhelper.flush()
+        for table, orders in self.orders.items():
+            if orders:
+                dbhelper.executemany_dml(
+                    "UPDATE %s SET _order=? WHERE uuid=?" % table,
+                    [(orderno, unpack_uuid(uuid)) for uuid, orderno in orders.items()]
+                )
+            orders.clear()
+
+
+# Commits data written by DBWriter in chunks of (at least) the given
+# number of rows, recording progress in import_progress table, so if the
+# import is interrupted, it can be resumed from the last checkpoint. The
+# importer reports each element it's about to process (by its number in
+# the parse events sequence), and chunks are committed only between
+# elements. On resume, the file is parsed again from the start (restoring
+# all the parser and writer state), but rows of elements up to the last
+# checkpoint are not written again.
+class CheckpointWriter:
+
+    def __init__(self, writer, every, fingerprint, resume=False):
+        self.writer = writer
+        self.every = every
+        self.fingerprint = fingerprint
+        self.rows = 0
+        self.pos = 0
+        if not dbhelper.table_columns("import_progress"):
+            raise ValueError("Database lacks import_progress table, upgrade it with: ppxml2db_init.py --upgrade")
+        progress = dict(dbhelper.query("SELECT name, value FROM import_progress"))
+        if resume:
+            if not progress:
+                raise ValueError("No interrupted import to resume in the database")
+            if progress["file"] != fingerprint:
+                raise ValueError("Interrupted import was of a different file (%s), can't resume" % progress["file"])
+            self.resume_from = int(progress["el_order"])
+            _log.info("Resuming import after element %d", self.resume_from)
+        else:
+            if progress:
+                raise ValueError("Database contains partial data of an interrupted import, continue it with --resume")
+            self.resume_from = 0
+
+    def insert(self, table, fields, returning=None):
+        if self.pos <= self.resume_from:
+            self.writer.register(table, fields)
+            return None
+        self.rows += 1
+        return self.writer.insert(table, fields, returning)
+
+    def set_order(self, table, xmlid, orderno):
+        self.writer.set_order(table, xmlid, orderno)
+
+    # Called by importer before processing each element.
+    def next_element(self, pos):
+        if self.rows >= self.every:
+            # All the preceding elements were processed.
+            self.save(pos - 1)
+        self.pos = pos
+
+    def save(self, done):
+        _log.info("Checkpoint after element %d", done)
+        dbhelper.execute_dml("DELETE FROM import_progress")
+        dbhelper.executemany_dml(
+            "INSERT INTO import_progress(name, value) VALUES (?, ?)",
+            [("file", self.fingerprint), ("el_order", str(done))]
+        )
+        dbhelper.commit()
+        self.rows = 0
+
+    def finish(self):
+        self.writer.finish()
+        dbhelper.execute_dml("DELETE FROM import_progress")
+
+
+def _norm(v):
+    # Values from XML are strings, while the database may return them
+    # converted to column type, so compare string representations.
+    if v is None:
+        return None
+    return str(v)
+
+
+# Synchronizes the database with the imported data, writing only the
+# differences: rows are matched with existing ones by their natural keys
+# and compared column by column (which includes updatedAt, where a table
+# has it; for _order, only relative order counts, see keep_order()), then
+# inserted, updated or deleted as needed. Rows are collected in memory and
+# written in finish() (except prices, which are synced one security at a
+# time), as _order of some rows is known only after their references are
+# seen.
+#
+# As existing rows keep their _id's, new securities, taxonomy categories,
+# etc. are added after the existing ones (PP appends new objects at the
+# end anyway).
+class IncrementalWriter:
+
+    # Tables with rows identified by key columns.
+    KEYED = {
+        "security": ("uuid",),
+        "account": ("uuid",),
+        "xact": ("uuid",),
+        "xact_cross_entry": ("to_xact",),
+        "latest_price": ("security",),
+        "taxonomy": ("uuid",),
+        "taxonomy_category": ("uuid",),
+        "property": ("name",),
+    }
+
+    # Tables with rows belonging to a parent row (per the given column). Rows
+    # of a parent are compared and replaced as a whole list.
+    CHILD = {
+        "security_attr": "security",
+        "security_prop": "security",
+        "security_event": "security",
+        "account_attr": "account",
+        "xact_unit": "xact",
+        "taxonomy_data": "taxonomy",
+    }
+
+    # Tables with rows identified only by _id, with their dependent tables
+    # (and the column referencing _id). These are small, and are compared
+    # and replaced as a whole.
+    GROUPS = {
+        "watchlist": [("watchlist_security", "list")],
+        "taxonomy_assignment": [("taxonomy_assignment_data", "assignment")],
+        "dashboard": [],
+        "bookmark": [],
+        "attribute_type": [],
+        "config_set": [("config_entry", "config_set")],
+    }
+
+    def __init__(self, keep_tables=()):
+        # Tables for which no rows are imported this time (e.g. --skip-prices),
+        # which thus should be left as is.
+        self.keep_tables = set(keep_tables)
+        self.columns = {}
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self.rows = defaultdict(dict)
+        self.xmlids = defaultdict(dict)
+        self.children = defaultdict(lambda: defaultdict(list))
+        self.group_rows = defaultdict(list)
+        self.group_child_tables = {ch for chs in self.GROUPS.values() for ch, _ in chs}
+        self.price_security = None
+        self.price_securities = set()
+        self.prices = {}
+
+    def table_columns(self, table):
+        cols = self.columns.get(table)
+        if cols is None:
+            cols = [(name, default) for name, default in dbhelper.table_columns(table) if name != "_id"]
+            self.columns[table] = cols
+        return cols
+
+    # Complete fields with default values of missing columns.
+    def make_row(self, table, fields):
+        return {name: fields.get(name, default) for name, default in self.table_columns(table)}
+
+    def norm_row(self, table, row):
+        return tuple(_norm(row[name]) for name, _ in self.table_columns(table))
+
+    def insert(self, table, fields, returning=None):
+        row = self.make_row(table, fields)
+        if table == "price":
+            self.insert_price(row)
+        elif table in self.KEYED:
+            key = tuple(_norm(row[c]) for c in self.KEYED[table])
+            self.rows[table][key] = row
+            if "_xmlid" in row:
+                self.xmlids[table][_norm(row["_xmlid"])] = key
+        elif table in self.CHILD:
+            self.children[table][_norm(row[self.CHILD[table]])].append(row)
+        elif table in self.GROUPS or table in self.group_child_tables:
+            rows = self.group_rows[table]
+            rows.append(row)
+            # Temporary id, remapped in finish().
+            return len(rows)
+        else:
+            raise NotImplementedError(table)
+
+    def set_order(self, table, xmlid, orderno):
+        key = self.xmlids[table].get(_norm(xmlid))
+        # A reference may occur within the element itself, before it's
+        # complete (and inserted), then its own position is used anyway.
+        if key is not None:
+            self.rows[table][key]["_order"] = orderno
+
+    def insert_price(self, row):
+        security = row["security"]
+        if security != self.price_security:
+            self.sync_prices()
+            assert security not in self.price_securities, security
+            self.price_security = security
+            self.price_securities.add(security)
+        self.prices[_norm(row["tstamp"])] = row
+
+    # Sync prices of the current security.
+    def sync_prices(self):
+        if self.price_security is None:
+            return
+        stats = self.stats["price"]
+        existing = {}
+        cols = [name for name, _ in self.table_columns("price") if name not in ("security", "tstamp")]
+        sql = "SELECT tstamp, %s FROM price WHERE security=?" % ", ".join(cols)
+        for r in dbhelper.iter_query(sql, (self.price_security,)):
+            existing[_norm(r[0])] = tuple(_norm(v) for v in r[1:])
+
+        updates = []
+        for tstamp, row in self.prices.items():
+            old = existing.pop(tstamp, None)
+            if old is None:
+                dbhelper.insert("price", row)
+                stats["inserted"] += 1
+            elif old != tuple(_norm(row[c]) for c in cols):
+                updates.append([row[c] for c in cols] + [self.price_security, row["tstamp"]])
+            else:
+                stats["unchanged"] += 1
+        if updates:
+            sql = "UPDATE price SET %s WHERE security=? AND tstamp=?" % ", ".join(c + "=?" for c in cols)
+            dbhelper.executemany_dml(sql, updates)
+            stats["updated"] += len(updates)
+        if existing:
+            dbhelper.executemany_dml(
+                "DELETE FROM price WHERE security=? AND tstamp=?",
+                [(self.price_security, t) for t in existing]
+            )
+            stats["deleted"] += len(existing)
+
+        self.price_security = None
+        self.prices = {}
+
+    # _order of a row is the position of its element (or of a reference to
+    # it) in the parse events of the file, so it shifts whenever anything
+    # before it changes (e.g. prices are added), while only the relative
+    # order of rows matters. So new _order values of rows (key -> row) are
+    # replaced with their existing ones (key -> _order), as long as the
+    # existing rows keep their relative order, and new rows get values in
+    # the gaps between their neighbors. Either way, the resulting values
+    # are in the new order. If existing values can't be kept, new ones are
+    # left as is (and so all rows get updated).
+    @staticmethod
+    def keep_order(rows, old_orders):
+        seq = sorted(rows, key=lambda k: int(rows[k]["_order"]))
+        kept = [old_orders[k] for k in seq if k in old_orders]
+        if not kept or any(a >= b for a, b in zip(kept, kept[1:])):
+            return
+        orders = {}
+        # Last existing value, new rows after it
+        lo = None
+        new_keys = []
+        for k in seq + [None]:
+            hi = old_orders.get(k) if k is not None else None
+            if k is not None and hi is None:
+                new_keys.append(k)
+                continue
+            if new_keys:
+                n = len(new_keys)
+                if hi is None:
+                    vals = range(lo + 1, lo + n + 1)
+                elif lo is None:
+                    vals = range(hi - n, hi)
+                elif hi - lo > n:
+                    vals = [lo + i * (hi - lo) // (n + 1) for i in range(1, n + 1)]
+                else:
+                    return
+                orders.update(zip(new_keys, vals))
+                new_keys = []
+            if k is not None:
+                orders[k] = lo = hi
+        for k, v in orders.items():
+            rows[k]["_order"] = v
+
+    def sync_keyed(self, table):
+        key_cols = self.KEYED[table]
+        cols = [name for name, _ in self.table_columns(table)]
+        stats = self.stats[table]
+        existing = {}
+        sql = "SELECT %s FROM %s" % (", ".join(cols), table)
+        for r in dbhelper.iter_query(sql):
+            row = dict(zip(cols, r))
+            existing[tuple(_norm(row[c]) for c in key_cols)] = self.norm_row(table, row)
+        if "_order" in cols:
+            idx = cols.index("_order")
+            self.keep_order(self.rows[table], {k: int(r[idx]) for k, r in existing.items()})
+
+        val_cols = [c for c in cols if c not in key_cols]
+        updates = []
+        for key, row in self.rows[table].items():
+            old = existing.pop(key, None)
+            if old is None:
+                dbhelper.insert(table, row)
+                stats["inserted"] += 1
+            elif old != self.norm_row(table, row):
+                updates.append([row[c] for c in val_cols] + [row[c] for c in key_cols])
+            else:
+                stats["unchanged"] += 1
+        where = " AND ".join(c + "=?" for c in key_cols)
+        if updates:
+            sql = "UPDATE %s SET %s WHERE %s" % (table, ", ".join(c + "=?" for c in val_cols), where)
+            dbhelper.executemany_dml(sql, updates)
+            stats["updated"] += len(updates)
+        if existing:
+            dbhelper.executemany_dml("DELETE FROM %s WHERE %s" % (table, where), list(existing))
+            stats["deleted"] += len(existing)
+
+    # Select normalized rows of a table (without _id), in the physical order.
+    def select_norm(self, table, order=None):
+        cols = [name for name, _ in self.table_columns(table)]
+        sql = "SELECT %s FROM %s" % (", ".join(cols), table)
+        if order is None and dbhelper.dbtype != "pgsql":
+            order = "rowid"
+        if order is not None:
+            sql += " ORDER BY " + order
+        return [tuple(_norm(v) for v in r) for r in dbhelper.iter_query(sql)]
+
+    def sync_child(self, table):
+        parent_col = self.CHILD[table]
+        parent_idx = [name for name, _ in self.table_columns(table)].index(parent_col)
+        stats = self.stats[table]
+        existing = defaultdict(list)
+        for r in self.select_norm(table):
+            existing[r[parent_idx]].append(r)
+
+        new = self.children[table]
+        changed = []
+        for parent in set(existing) | set(new):
+            new_rows = new.get(parent, [])
+            old_rows = existing.get(parent, [])
+            if [self.norm_row(table, r) for r in new_rows] == old_rows:
+                stats["unchanged"] += len(old_rows)
+            else:
+                changed.append(parent)
+        if not changed:
+            return
+
+        dbhelper.executemany_dml("DELETE FROM %s WHERE %s=?" % (table, parent_col), [(p,) for p in changed])
+        # Keep the order in which parents were seen in the import data.
+        changed = set(changed)
+        for parent, rows in new.items():
+            if parent in changed:
+                for row in rows:
+                    dbhelper.insert(table, row)
+                stats["inserted"] += len(rows)
+        stats["deleted"] += sum(len(existing.get(p, ())) for p in changed)
+
+    def sync_group(self, table):
+        child_specs = self.GROUPS[table]
+        old_parents = []
+        old_pos = {}
+        cols = [name for name, _ in self.table_columns(table)]
+        sql = "SELECT _id, %s FROM %s ORDER BY _id" % (", ".join(cols), table)
+        for r in dbhelper.iter_query(sql):
+            old_pos[r[0]] = len(old_pos)
+            old_parents.append(tuple(_norm(v) for v in r[1:]))
+        if "_order" in cols:
+            # Groups are matched by position.
+            idx = cols.index("_order")
+            self.keep_order(
+                dict(enumerate(self.group_rows[table])),
+                {i: int(r[idx]) for i, r in enumerate(old_parents)}
+            )
+        new_parents = [self.norm_row(table, r) for r in self.group_rows[table]]
+        same = old_parents == new_parents
+
+        old_children = {}
+        for ch_table, ref_col in child_specs:
+            ref_idx = [name for name, _ in self.table_columns(ch_table)].index(ref_col)
+            old_rows = []
+            for r in self.select_norm(ch_table):
+                r = list(r)
+                r[ref_idx] = old_pos.get(int(r[ref_idx]))
+                old_rows.append(r)
+            old_children[ch_table] = old_rows
+            # Temporary ids for new rows are positions + 1.
+            new_rows = []
+            for row in self.group_rows[ch_table]:
+                r = list(self.norm_row(ch_table, row))
+                r[ref_idx] = row[ref_col] - 1
+                new_rows.append(r)
+            same = same and old_rows == new_rows
+
+        if same:
+            self.stats[table]["unchanged"] += len(old_parents)
+            for ch_table, _ in child_specs:
+                self.stats[ch_table]["unchanged"] += len(old_children[ch_table])
+            return
+
+        for ch_table, _ in child_specs:
+            dbhelper.execute_dml("DELETE FROM %s" % ch_table)
+            self.stats[ch_table]["deleted"] += len(old_children[ch_table])
+        dbhelper.execute_dml("DELETE FROM %s" % table)
+        self.stats[table]["deleted"] += len(old_parents)
+
+        id_map = {}
+        for i, row in enumerate(self.group_rows[table], 1):
+            if child_specs:
+                id_map[i] = dbhelper.insert(table, row, returning="_id")
+            else:
+                dbhelper.insert(table, row)
+        self.stats[table]["inserted"] += len(self.group_rows[table])
+        for ch_table, ref_col in child_specs:
+            for row in self.group_rows[ch_table]:
+                row[ref_col] = id_map[row[ref_col]]
+                dbhelper.insert(ch_table, row)
+            self.stats[ch_table]["inserted"] += len(self.group_rows[ch_table])
+
+    def finish(self):
+        if "price" not in self.keep_tables:
+            self.sync_prices()
+            # Securities without prices in the import data
+            sql = "SELECT security, COUNT(*) FROM price GROUP BY security"
+            for security, cnt in list(dbhelper.iter_query(sql)):
+                if security not in self.price_securities:
+                    dbhelper.execute_dml("DELETE FROM price WHERE security=?", (security,))
+                    self.stats["price"]["deleted"] += cnt
+        for table in self.KEYED:
+            if table not in self.keep_tables:
+                self.sync_keyed(table)
+        for table in self.CHILD:
+            if table not in self.keep_tables:
+                self.sync_child(table)
+        for table in self.GROUPS:
+            if table not in self.keep_tables:
+                self.sync_group(table)
+        dbhelper.flush()
+
+    def report(self, f):
+        for table in sorted(self.stats):
+            stats = self.stats[table]
+            print("%-24s inserted: %d, updated: %d, deleted: %d, unchanged: %d" % (
+                table, stats["inserted"], stats["updated"], stats["deleted"], stats["unchanged"]
+            ), file=f)
+
+
+# Performs database writes of another writer in a separate thread, so XML
+# parsing and database I/O overlap. Operations are passed to the writer
+# thread in chunks, via a bounded queue (so if writing is slower than
+# parsing, the parser blocks instead of accumulating unbounded data).
+class ThreadedWriter:
+
+    def __init__(self, writer, queue_size=64, chunk_size=1000):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.chunk_size = max(chunk_size, 1)
+        self.chunk = []
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            for func, args, future in chunk:
+                # After an error, keep draining the queue so the parser
+                # doesn't block, the error is reported to it on next put.
+                if self.error is not None:
+                    if future is not None:
+                        future.set_exception(self.error)
+                    continue
+                try:
+                    res = func(*args)
+                except BaseException as e:
+                    self.error = e
+                    if future is not None:
+                        future.set_exception(e)
+                    continue
+                if future is not None:
+                    future.set_result(res)
+
+    def put_chunk(self):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(self.chunk)
+        self.chunk = []
+
+    def insert(self, table, fields, returning=None):
+        if returning:
+            # Caller needs the result (_id) right away, so wait for the
+            # writer thread to get to it.
+            future = Future()
+            self.chunk.append((self.writer.insert, (table, fields, returning), future))
+            self.put_chunk()
+            return future.result()
+        self.chunk.append((self.writer.insert, (table, fields), None))
+        if len(self.chunk) >= self.chunk_size:
+            self.put_chunk()
+
+    def set_order(self, table, xmlid, orderno):
+        self.chunk.append((self.writer.set_order, (table, xmlid, orderno), None))
+        if len(self.chunk) >= self.chunk_size:
+            self.put_chunk()
+
+    # Stop the thread (after it executes what's already queued), without
+    # finishing the writer, e.g. on error.
+    def abort(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def finish(self):
+        self.put_chunk()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.writer.finish()
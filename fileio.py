@@ -0,0 +1,135 @@
+import gzip
+import bz2
+import lzma
+import zipfile
+import time
+
+try:
+    import zstandard
+except ImportError:
+    # Optional, zstd files are supported only if installed
+    zstandard = None
+
+
+# Input/output of (possibly compressed) XML files. Compressed data is
+# decompressed/compressed on the fly while streaming, without temporary
+# files. Besides plain compressed files, ZIP container, which PP uses to
+# save compressed XML files, is supported.
+
+# Buffer size for uncompressed files
+BUFFER_SIZE = 1024 * 1024
+
+# Compression format -> magic number at the start of file
+MAGICS = {
+    "gzip": b"\x1f\x8b",
+    "xz": b"\xfd7zXZ\x00",
+    "bz2": b"BZh",
+    "zstd": b"\x28\xb5\x2f\xfd",
+    "zip": b"PK\x03\x04",
+}
+
+# Magic numbers of PP's file formats which can't be handled
+UNSUPPORTED_MAGICS = {
+    b"PORTFOLIO": "encrypted",
+    b"PPPBV1": "binary",
+}
+
+# Name of XML file in PP's ZIP container
+ZIP_MEMBER = "data.xml"
+
+SUFFIXES = {
+    ".gz": "gzip",
+    ".xz": "xz",
+    ".bz2": "bz2",
+    ".zst": "zstd",
+    ".zip": "zip",
+}
+
+
+def _open_zstd(fname, mode):
+    if zstandard is None:
+        raise ValueError("Python module 'zstandard' is required for zstd compressed file: %s" % fname)
+    f = open(fname, mode)
+    if mode == "rb":
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    return zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+
+
+def _open_zip_member(fname):
+    with zipfile.ZipFile(fname) as zf:
+        names = zf.namelist()
+        if ZIP_MEMBER in names:
+            name = ZIP_MEMBER
+        else:
+            xml_names = [n for n in names if n.endswith(".xml")]
+            if len(xml_names) != 1:
+                raise ValueError("Can't find XML file in ZIP file: %s" % fname)
+            name = xml_names[0]
+        # The member stays readable after ZipFile is closed.
+        return zf.open(name)
+
+
+# Writes XML into a member of a ZIP file, like PP does when saving XML
+# file compressed.
+class ZipMemberWriter:
+
+    def __init__(self, fname, member=ZIP_MEMBER):
+        self.zf = zipfile.ZipFile(fname, "w", zipfile.ZIP_DEFLATED)
+        info = zipfile.ZipInfo(member, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        self.f = self.zf.open(info, "w")
+        self.write = self.f.write
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+        self.zf.close()
+
+
+def _open(fname, mode, fmt):
+    if fmt == "gzip":
+        # Default level 9 is much slower for little gain.
+        return gzip.open(fname, mode, compresslevel=6)
+    if fmt == "xz":
+        return lzma.open(fname, mode)
+    if fmt == "bz2":
+        return bz2.open(fname, mode)
+    if fmt == "zstd":
+        return _open_zstd(fname, mode)
+    if fmt == "zip":
+        if mode == "rb":
+            return _open_zip_member(fname)
+        return ZipMemberWriter(fname)
+    return open(fname, mode, buffering=BUFFER_SIZE)
+
+
+# Detect compression format of a file by its content.
+def detect_format(fname):
+    with open(fname, "rb") as f:
+        head = f.read(16)
+    for fmt, magic in MAGICS.items():
+        if head.startswith(magic):
+            return fmt
+    for magic, fmt in UNSUPPORTED_MAGICS.items():
+        if head.startswith(magic):
+            raise ValueError("PP %s file format is not supported (save it as XML): %s" % (fmt, fname))
+    return None
+
+
+# Open file for reading as a binary stream, decompressing it (or
+# extracting XML from ZIP) if needed.
+def open_input(fname):
+    return _open(fname, "rb", detect_format(fname))
+
+
+# Open file for writing as a binary stream, compressing it if the file
+# name has a suffix of a compression format (or if fmt is given).
+def open_output(fname, fmt=None):
+    if fmt is None:
+        for suffix, suffix_fmt in SUFFIXES.items():
+            if fname.endswith(suffix):
+                fmt = suffix_fmt
+                break
+    return _open(fname, "wb", fmt)
@@ -0,0 +1,7 @@
+-- Progress of an import done with ppxml2db.py --checkpoint-every, which
+-- was interrupted (empty otherwise), to continue it with --resume.
+CREATE TABLE import_progress(
+name VARCHAR(64) NOT NULL,
+value TEXT NOT NULL
+);
+CREATE UNIQUE INDEX import_progress__name ON import_progress(name);
@@ -0,0 +1,142 @@
+from collections import namedtuple
+
+
+# Declarative mapping between PP XML elements and database columns, shared
+# by the importer and the exporter (which compile it into field extractors
+# and emitters respectively), so both directions stay in sync.
+#
+# A mapping of an element is a tuple of groups of fields, in XML order.
+# Between the groups, the element has children which aren't plain fields
+# (like <prices> of a security), and are handled by the code.
+
+# tag: name of XML child element/attribute, col: DB column, kind:
+# "text" - child element text,
+# "bool" - child element text, "true"/"false" in XML, 1/0 in DB,
+# "attr" - attribute,
+# "xmlid" - id attribute, stored on import only (ids are renumbered on
+#           export).
+Field = namedtuple("Field", "tag col kind")
+
+
+def F(tag, col=None):
+    return Field(tag, col or tag, "text")
+
+
+def Bool(tag, col=None):
+    return Field(tag, col or tag, "bool")
+
+
+def Attr(tag, col=None):
+    return Field(tag, col or tag, "attr")
+
+
+XMLID = Field("id", "_xmlid", "xmlid")
+
+
+CLIENT = (
+    [F("version"), F("baseCurrency")],
+)
+
+SECURITY = (
+    [
+        F("uuid"), F("onlineId"), F("name"),
+        F("currencyCode", "currency"), F("targetCurrencyCode", "targetCurrency"),
+        F("note"), F("isin"), F("tickerSymbol"), F("calendar"), F("wkn"),
+        F("feedTickerSymbol"), F("feed"), F("feedURL"),
+    ],
+    # <prices>
+    [F("latestFeed"), F("latestFeedURL")],
+    # <latest>, <attributes>, <events>, <property>'s
+    [Bool("isRetired"), F("updatedAt")],
+)
+
+PRICE = (
+    [Attr("t", "tstamp"), Attr("v", "value")],
+)
+
+LATEST_PRICE = (
+    [Attr("t", "tstamp"), Attr("v", "value"), F("high"), F("low"), F("volume")],
+)
+
+SECURITY_EVENT = (
+    [F("date"), F("type"), F("details")],
+)
+
+WATCHLIST = (
+    [F("name")],
+)
+
+ACCOUNT = (
+    [XMLID, F("uuid"), F("name"), F("currencyCode", "currency"), F("note"), Bool("isRetired")],
+    # <transactions>, <attributes>
+    [F("updatedAt")],
+)
+
+PORTFOLIO = (
+    [XMLID, F("uuid"), F("name"), F("note"), Bool("isRetired")],
+    # <referenceAccount>, <transactions>, <attributes>
+    [F("updatedAt")],
+)
+
+XACT = (
+    [XMLID, F("uuid"), F("date"), F("currencyCode", "currency"), F("amount")],
+    # <security>, <crossEntry>
+    [F("shares"), F("note"), F("source")],
+    # <units>
+    [F("updatedAt"), F("type")],
+)
+
+TAXONOMY = (
+    [F("id", "uuid"), F("name")],
+    # <dimensions>, <root>
+)
+
+TAXONOMY_CATEGORY = (
+    [F("id", "uuid"), F("name"), F("color")],
+    # <parent>, <children>, <assignments>
+    [F("weight"), F("rank")],
+    # <data>
+)
+
+TAXONOMY_ASSIGNMENT = (
+    # <investmentVehicle>
+    [F("weight"), F("rank")],
+    # <data>
+)
+
+DASHBOARD = (
+    [Attr("name"), F("id")],
+    # <configuration>, <columns>
+)
+
+DASHBOARD_COLUMN = (
+    [F("weight")],
+)
+
+DASHBOARD_WIDGET = (
+    [F("label")],
+)
+
+BOOKMARK = (
+    [F("label"), F("pattern")],
+)
+
+LIMIT_PRICE = (
+    [F("operator"), F("value")],
+)
+
+ATTRIBUTE_TYPE = (
+    [
+        F("id"), F("name"), F("columnLabel"), F("source"), F("target"),
+        F("type"), F("converterClass"),
+    ],
+    # <properties>
+)
+
+CONFIG_SET = (
+    [F("string", "name")],
+)
+
+CONFIG_ENTRY = (
+    [F("uuid"), F("name"), F("data")],
+)
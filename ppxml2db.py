@@ -11,6 +11,13 @@ import lxml.etree as ET
 
 from version import __version__
 import dbhelper
+import fileio
+import ppxml2db_init
+from dbwriter import DBWriter, IncrementalWriter, ThreadedWriter, CheckpointWriter
+from stats import Stats
+from compact import pack_uuid, unpack_uuid
+from pricesync import PriceSync
+import mapping
 
 
 _log = logging.getLogger(__name__)
@@ -20,12 +27,6 @@ _log = logging.getLogger(__name__)
 #    datefmt='%Y-%m-%d %H:%M:%S',
 #)
 
-# Rename field in a dictionary
-def ren(d, old, new):
-    if old in d:
-        d[new] = d[old]
-        del d[old]
-
 
 def as_bool(v):
     return {"false": 0, "true": 1}[v]
@@ -35,33 +36,124 @@ def dump_el(el):
     print(ET.tostring(el).decode())
 
 
-class PortfolioPerformanceXML2DB:
+# Compile element mapping (see mapping.py) into a function returning dict
+# of column values from an element. Children of the element are scanned
+# once (first child with a given tag is used), absent fields are not in
+# the dict.
+def compile_extractor(groups):
+    children = {}
+    attrs = []
+    for group in groups:
+        for f in group:
+            if f.kind in ("attr", "xmlid"):
+                attrs.append((f.tag, f.col))
+            else:
+                children[f.tag] = (f.col, as_bool if f.kind == "bool" else None)
 
-    def parse_props(self, el, props):
+    def extract(el):
         d = {}
-        for p in props:
-            conv = lambda x: x
-            if isinstance(p, tuple):
-                conv = p[1]
-                p = p[0]
-            pel = el.find(p)
-            if pel is not None:
-                d[p] = conv("" if pel.text is None else pel.text)
-            elif p in el.attrib:
-                # Otherwise try attribute (will return None if not there)
-                d[p] = conv(el.get(p))
+        if children:
+            for ch in el:
+                spec = children.get(ch.tag)
+                if spec is not None:
+                    col, conv = spec
+                    if col not in d:
+                        text = ch.text
+                        if text is None:
+                            text = ""
+                        d[col] = text if conv is None else conv(text)
+        for tag, col in attrs:
+            v = el.get(tag)
+            if v is not None:
+                d[col] = v
         return d
 
+    return extract
+
+
+# Same as compile_extractor(), but for the streaming parser backend (see
+# ImportTarget): the function takes dict of texts of (leaf) children of
+# an element by tag, and dict of its attributes.
+def compile_field_extractor(groups):
+    children = []
+    attrs = []
+    for group in groups:
+        for f in group:
+            if f.kind in ("attr", "xmlid"):
+                attrs.append((f.tag, f.col))
+            else:
+                children.append((f.tag, f.col, as_bool if f.kind == "bool" else None))
+
+    def extract(texts, attrib):
+        d = {}
+        for tag, col, conv in children:
+            if tag in texts:
+                text = texts[tag]
+                if text is None:
+                    text = ""
+                d[col] = text if conv is None else conv(text)
+        for tag, col in attrs:
+            v = attrib.get(tag)
+            if v is not None:
+                d[col] = v
+        return d
+
+    return extract
+
+
+extract_client = compile_extractor(mapping.CLIENT)
+extract_security = compile_extractor(mapping.SECURITY)
+extract_price = compile_extractor(mapping.PRICE)
+extract_latest_price = compile_extractor(mapping.LATEST_PRICE)
+extract_security_event = compile_extractor(mapping.SECURITY_EVENT)
+extract_watchlist = compile_extractor(mapping.WATCHLIST)
+extract_account = compile_extractor(mapping.ACCOUNT)
+extract_portfolio = compile_extractor(mapping.PORTFOLIO)
+extract_xact = compile_extractor(mapping.XACT)
+extract_taxonomy = compile_extractor(mapping.TAXONOMY)
+extract_taxonomy_category = compile_extractor(mapping.TAXONOMY_CATEGORY)
+extract_taxonomy_assignment = compile_extractor(mapping.TAXONOMY_ASSIGNMENT)
+extract_dashboard = compile_extractor(mapping.DASHBOARD)
+extract_dashboard_column = compile_extractor(mapping.DASHBOARD_COLUMN)
+extract_dashboard_widget = compile_extractor(mapping.DASHBOARD_WIDGET)
+extract_bookmark = compile_extractor(mapping.BOOKMARK)
+extract_limit_price = compile_extractor(mapping.LIMIT_PRICE)
+extract_attribute_type = compile_extractor(mapping.ATTRIBUTE_TYPE)
+extract_config_set = compile_extractor(mapping.CONFIG_SET)
+extract_config_entry = compile_extractor(mapping.CONFIG_ENTRY)
+
+
+ACCOUNT_TAGS = ("account", "referenceAccount", "accountFrom", "accountTo")
+PORTFOLIO_TAGS = ("portfolio", "portfolioFrom", "portfolioTo")
+# Elements defining (or referencing) objects which contain other ones
+# (and so are tracked on container stack).
+CONTAINER_TAGS = ("security",) + ACCOUNT_TAGS + PORTFOLIO_TAGS
+XACT_TAGS = (
+    "account-transaction", "accountTransaction", "portfolio-transaction", "portfolioTransaction",
+    "transactionFrom", "transactionTo",
+)
+
+# crossEntry class -> tags of its children referencing (from account,
+# from transaction, to account, to transaction).
+CROSS_ENTRY_REFS = {
+    "buysell": ("portfolio", "portfolioTransaction", "account", "accountTransaction"),
+    "account-transfer": ("accountFrom", "transactionFrom", "accountTo", "transactionTo"),
+    "portfolio-transfer": ("portfolioFrom", "transactionFrom", "portfolioTo", "transactionTo"),
+}
+
+
+class PortfolioPerformanceXML2DB:
+
     def uuid(self, el):
         id = el.get("reference")
         if id is None:
             id = el.get("id")
         assert id is not None
-        return self.id2uuid_map[id]
+        return unpack_uuid(self.id2uuid_map[int(id)])
 
     @staticmethod
     def is_account_tag(tag):
-        return tag in ("account", "referenceAccount", "accountFrom", "accountTo")
+        return tag in ACCOUNT_TAGS
 
     def parse_entry(self, entry_el):
         els = entry_el.findall("*")
@@ -84,10 +176,10 @@ class PortfolioPerformanceXML2DB:
             assert len(els) == 2
             assert els[0].tag == "string"
             if els[1].tag == "limitPrice":
-                fields = self.parse_props(els[1], ("operator", "value"))
+                fields = extract_limit_price(els[1])
                 value = "%s %s" % (fields["operator"], fields["value"])
             elif els[1].tag == "bookmark":
-                fields = self.parse_props(els[1], ("label", "pattern"))
+                fields = extract_bookmark(els[1])
                 if not fields:
                     value = None
                 else:
@@ -103,196 +195,156 @@ class PortfolioPerformanceXML2DB:
             yield fields
 
     def handle_price(self, price_el):
-            props = ["t", "v"]
-            price_fields = self.parse_props(price_el, props)
-            ren(price_fields, "v", "value")
-            ren(price_fields, "t", "tstamp")
+            price_fields = extract_price(price_el)
             price_fields["security"] = self.cur_uuid()
-            dbhelper.insert("price", price_fields)
+            self.writer.insert("price", price_fields)
 
     def handle_latest(self, latest_el):
         if latest_el is not None:
-            props = ["t", "v", "high", "low", "volume"]
-            latest_fields = self.parse_props(latest_el, props)
-            ren(latest_fields, "v", "value")
-            ren(latest_fields, "t", "tstamp")
+            latest_fields = extract_latest_price(latest_el)
             latest_fields["security"] = self.cur_uuid()
-            dbhelper.insert("latest_price", latest_fields)
+            self.writer.insert("latest_price", latest_fields)
 
     def handle_event(self, event_el):
-            props = ["date", "type", "details"]
-            fields = self.parse_props(event_el, props)
+            fields = extract_security_event(event_el)
             fields["security"] = self.cur_uuid()
-            dbhelper.insert("security_event", fields)
+            self.writer.insert("security_event", fields)
 
     def handle_security(self, el):
         if el.get("reference") is not None:
             return
 
-        props = [
-            "uuid", "onlineId", "name", "currencyCode", "targetCurrencyCode", "note",
-            "isin", "tickerSymbol", "calendar", "wkn", "feedTickerSymbol",
-            "feed", "feedURL", "latestFeed", "latestFeedURL",
-            ("isRetired", as_bool), "updatedAt"
-        ]
-        sec = self.parse_props(el, props)
-        ren(sec, "currencyCode", "currency")
-        ren(sec, "targetCurrencyCode", "targetCurrency")
-        dbhelper.insert("security", sec)
-
-        for fields in self.parse_attributes(el):
+        props = [(p.get("type"), p.get("name"), p.text) for p in el.findall("property")]
+        self.insert_security(extract_security(el), self.parse_attributes(el), props)
+
+    # The insert_*() methods below are shared by both parser backends, and
+    # take data already extracted from XML (see handle_*() for iterparse,
+    # and ImportTarget).
+
+    # attrs: as returned by parse_attributes(), props: [(type, name, value)]
+    def insert_security(self, sec, attrs, props):
+        self.writer.insert("security", sec)
+
+        for fields in attrs:
             fields["security"] = sec["uuid"]
-            dbhelper.insert("security_attr", fields)
+            self.writer.insert("security_attr", fields)
 
-        prop_els = el.findall("property")
-        for seq, prop_el in enumerate(prop_els):
+        for seq, (typ, name, value) in enumerate(props):
             fields = {
-                "security": sec["uuid"], "type": prop_el.get("type"),
-                "name": prop_el.get("name"), "value": prop_el.text, "seq": seq,
+                "security": sec["uuid"], "type": typ,
+                "name": name, "value": value, "seq": seq,
             }
-            dbhelper.insert("security_prop", fields)
-
-    def handle_account_attrs(self, pel, uuid):
-        for fields in self.parse_attributes(pel):
-            fields["account"] = uuid
-            dbhelper.insert("account_attr", fields)
+            self.writer.insert("security_prop", fields)
 
     def handle_account(self, el, orderno):
-        props = ["uuid", "name", "currencyCode", "note", ("isRetired", as_bool), "updatedAt", "id"]
-        fields = self.parse_props(el, props)
-        ren(fields, "currencyCode", "currency")
-        ren(fields, "id", "_xmlid")
-        fields["type"] = "account"
-        fields["_order"] = orderno
-        dbhelper.insert("account", fields)
-        self.handle_account_attrs(el, fields["uuid"])
+        self.insert_account(extract_account(el), "account", orderno, self.parse_attributes(el))
 
     def handle_portfolio(self, el, orderno):
-        props = ["uuid", "name", "note", ("isRetired", as_bool), "updatedAt", "id"]
-        fields = self.parse_props(el, props)
-        ren(fields, "id", "_xmlid")
+        fields = extract_portfolio(el)
         acc = el.find("referenceAccount")
         fields["referenceAccount"] = self.uuid(acc)
-        fields["type"] = "portfolio"
+        self.insert_account(fields, "portfolio", orderno, self.parse_attributes(el))
+
+    def insert_account(self, fields, typ, orderno, attrs):
+        fields["type"] = typ
         fields["_order"] = orderno
-        dbhelper.insert("account", fields)
-        self.handle_account_attrs(el, fields["uuid"])
+        self.writer.insert("account", fields)
+        for attr_fields in attrs:
+            attr_fields["account"] = fields["uuid"]
+            self.writer.insert("account_attr", attr_fields)
 
     def handle_watchlist(self, el, orderno):
-        fields = self.parse_props(el, ["name"])
+        fields = extract_watchlist(el)
         fields["_order"] = orderno
-        id = dbhelper.insert("watchlist", fields, returning="_id")
+        id = self.writer.insert("watchlist", fields, returning="_id")
         for sec in el.findall("securities/security"):
             fields = {"list": id, "security": self.uuid(sec)}
-            dbhelper.insert("watchlist_security", fields)
+            self.writer.insert("watchlist_security", fields)
 
     def handle_xact(self, acc_type, acc_uuid, el, orderno):
+        units = []
+        for unit_el in el.findall("units/unit"):
+            rate_el = unit_el.find("exchangeRate")
+            units.append((
+                unit_el.get("type"), unit_el.find("amount"), unit_el.find("forex"),
+                None if rate_el is None else rate_el.text,
+            ))
+        self.insert_xact(acc_type, acc_uuid, extract_xact(el), el.find("security"), units, orderno)
+
+    # sec: <security> element (or its attributes dict), or None. units:
+    # [(type, <amount>, <forex> or None, exchangeRate or None)], with
+    # elements (or attributes dicts) for amounts.
+    def insert_xact(self, acc_type, acc_uuid, fields, sec, units, orderno):
         # Start with calculating unit aggregates, to add to xact row in DB.
         units_dict = defaultdict(int)
-        for unit_el in el.findall("units/unit"):
-            am_el = unit_el.find("amount")
-            units_dict[unit_el.get("type")] += int(am_el.get("amount"))
-
-        props = [
-            "uuid",
-            "date",
-            "currencyCode",
-            "amount",
-            "shares",
-            "note",
-            "source",
-            "updatedAt",
-            "type",
-            "id",
-        ]
-        fields = self.parse_props(el, props)
-        ren(fields, "currencyCode", "currency")
-        ren(fields, "id", "_xmlid")
+        for typ, amount, forex, rate in units:
+            units_dict[typ] += int(amount.get("amount"))
+
         fields["account"] = acc_uuid
         fields["acctype"] = acc_type
         fields["_order"] = orderno
-        sec = el.find("security")
         if sec is not None:
             fields["security"] = self.uuid(sec)
         fields["fees"] = units_dict["FEE"]
         fields["taxes"] = units_dict["TAX"]
-        dbhelper.insert("xact", fields)
+        self.writer.insert("xact", fields)
 
         xact_uuid = fields["uuid"]
-        for unit_el in el.findall("units/unit"):
-            am_el = unit_el.find("amount")
+        for typ, amount, forex, rate in units:
             fields = {
                 "xact": xact_uuid,
-                "type": unit_el.get("type"),
-                "amount": am_el.get("amount"),
-                "currency": am_el.get("currency"),
+                "type": typ,
+                "amount": amount.get("amount"),
+                "currency": amount.get("currency"),
             }
-            forex_el = unit_el.find("forex")
-            if forex_el is not None:
-                fields["forex_amount"] = forex_el.get("amount")
-                fields["forex_currency"] = forex_el.get("currency")
-            rate_el = unit_el.find("exchangeRate")
-            if rate_el is not None:
-                fields["exchangeRate"] = rate_el.text
-            dbhelper.insert("xact_unit", fields)
+            if forex is not None:
+                fields["forex_amount"] = forex.get("amount")
+                fields["forex_currency"] = forex.get("currency")
+            if rate is not None:
+                fields["exchangeRate"] = rate
+            self.writer.insert("xact_unit", fields)
 
     def handle_crossEntry(self, x_el):
-            if x_el.get("reference") is not None:
-                return
-
-            typ = x_el.get("class")
-            if typ == "buysell":
-                fields = {
-                    "type": typ,
-                    "from_acc": self.uuid(x_el.find("portfolio")),
-                    "from_xact": self.uuid(x_el.find("portfolioTransaction")),
-                    "to_acc": self.uuid(x_el.find("account")),
-                    "to_xact": self.uuid(x_el.find("accountTransaction")),
-                }
-            elif typ == "account-transfer":
-                fields = {
-                    "type": typ,
-                    "from_acc": self.uuid(x_el.find("accountFrom")),
-                    "from_xact": self.uuid(x_el.find("transactionFrom")),
-                    "to_acc": self.uuid(x_el.find("accountTo")),
-                    "to_xact": self.uuid(x_el.find("transactionTo")),
-                }
-            elif typ == "portfolio-transfer":
-                fields = {
-                    "type": typ,
-                    "from_acc": self.uuid(x_el.find("portfolioFrom")),
-                    "from_xact": self.uuid(x_el.find("transactionFrom")),
-                    "to_acc": self.uuid(x_el.find("portfolioTo")),
-                    "to_xact": self.uuid(x_el.find("transactionTo")),
-                }
-            else:
-                raise NotImplementedError(typ)
-            dbhelper.insert("xact_cross_entry", fields)
+        if x_el.get("reference") is not None:
+            return
+        self.insert_cross_entry(x_el.get("class"), x_el.find)
+
+    # find_ref: function returning child element (or its attributes dict)
+    # by tag.
+    def insert_cross_entry(self, typ, find_ref):
+        tags = CROSS_ENTRY_REFS.get(typ)
+        if tags is None:
+            raise NotImplementedError(typ)
+        from_acc, from_xact, to_acc, to_xact = [self.uuid(find_ref(tag)) for tag in tags]
+        fields = {
+            "type": typ,
+            "from_acc": from_acc,
+            "from_xact": from_xact,
+            "to_acc": to_acc,
+            "to_xact": to_xact,
+        }
+        self.writer.insert("xact_cross_entry", fields)
 
     def handle_taxonomy(self, taxon_el):
-            props = ["id", "name"]
-            fields = self.parse_props(taxon_el, props)
-            ren(fields, "id", "uuid")
+            fields = extract_taxonomy(taxon_el)
             for dim_els in taxon_el.findall("dimensions/string"):
                 dim_fields = {
                     "taxonomy": fields["uuid"],
                     "name": "dimension",
                     "value": dim_els.text,
                 }
-                dbhelper.insert("taxonomy_data", dim_fields)
+                self.writer.insert("taxonomy_data", dim_fields)
             root_el = taxon_el.find("root")
             fields["root"] = self.uuid(root_el)
-            dbhelper.insert("taxonomy", fields)
+            self.writer.insert("taxonomy", fields)
             self.handle_taxonomy_level(fields["uuid"], None, root_el)
 
     def handle_taxonomy_level(self, taxon_uuid, parent_uuid, level_el):
-        props = ["id", "name", "color", "weight", "rank"]
-        fields = self.parse_props(level_el, props)
-        ren(fields, "id", "uuid")
+        fields = extract_taxonomy_category(level_el)
         fields["parent"] = parent_uuid
         fields["taxonomy"] = taxon_uuid
         level_uuid = fields["uuid"]
-        dbhelper.insert("taxonomy_category", fields)
+        self.writer.insert("taxonomy_category", fields)
 
         for data_el in level_el.findall("data/entry"):
             data = self.parse_entry(data_el)
@@ -303,17 +355,16 @@ class PortfolioPerformanceXML2DB:
                 "category": level_uuid,
                 "taxonomy": taxon_uuid,
             }
-            dbhelper.insert("taxonomy_data", fields)
+            self.writer.insert("taxonomy_data", fields)
 
         for as_el in level_el.findall("assignments/assignment"):
-            props = ["weight", "rank"]
-            fields = self.parse_props(as_el, props)
+            fields = extract_taxonomy_assignment(as_el)
             el = as_el.find("investmentVehicle")
             fields["item_type"] = el.get("class")
             fields["item"] = self.uuid(el)
             fields["category"] = level_uuid
             fields["taxonomy"] = taxon_uuid
-            id = dbhelper.insert("taxonomy_assignment", fields, returning="_id")
+            id = self.writer.insert("taxonomy_assignment", fields, returning="_id")
             for data_el in as_el.findall("data/entry"):
                 data = self.parse_entry(data_el)
                 fields = {
@@ -322,24 +373,22 @@ class PortfolioPerformanceXML2DB:
                     "type": data[1][0],
                     "value": data[1][1],
                 }
-                dbhelper.insert("taxonomy_assignment_data", fields)
+                self.writer.insert("taxonomy_assignment_data", fields)
 
         for ch_el in level_el.findall("children/classification"):
             self.handle_taxonomy_level(taxon_uuid, level_uuid, ch_el)
 
     def handle_dashboard(self, dashb_el):
-            props = ["id", "name"]
-            fields = self.parse_props(dashb_el, props)
+            fields = extract_dashboard(dashb_el)
             conf = self.parse_configuration(dashb_el)
             fields["config_json"] = json.dumps(conf)
 
             columns = []
             for col_el in dashb_el.findall("columns/column"):
-                props = ["weight"]
-                col_fields = self.parse_props(col_el, props)
+                col_fields = extract_dashboard_column(col_el)
                 col_fields["widgets"] = []
                 for widget_el in col_el.findall("widgets/widget"):
-                    wid_fields = self.parse_props(widget_el, ["label"])
+                    wid_fields = extract_dashboard_widget(widget_el)
                     wid_fields["type"] = widget_el.get("type")
                     if widget_el.find("configuration") is not None:
                         conf = self.parse_configuration(widget_el)
@@ -347,33 +396,28 @@ class PortfolioPerformanceXML2DB:
                     col_fields["widgets"].append(wid_fields)
                 columns.append(col_fields)
             fields["columns_json"] = json.dumps(columns)
-            dbhelper.insert("dashboard", fields)
+            self.writer.insert("dashboard", fields)
 
     def handle_settings(self, settings_el):
         for bmark_el in settings_el.findall("bookmarks/bookmark"):
-            props = ["label", "pattern"]
-            fields = self.parse_props(bmark_el, props)
-            dbhelper.insert("bookmark", fields)
+            fields = extract_bookmark(bmark_el)
+            self.writer.insert("bookmark", fields)
 
         for attr_type_el in settings_el.findall("attributeTypes/attribute-type"):
-            props = ["id", "name", "columnLabel", "source", "target", "type", "converterClass"]
-            fields = self.parse_props(attr_type_el, props)
+            fields = extract_attribute_type(attr_type_el)
             props = []
             for p in self.parse_attributes(attr_type_el, "properties"):
                 props.append({"name": p["attr_uuid"], "type": p["type"], "value": p["value"]})
             fields["props_json"] = json.dumps(props)
-            dbhelper.insert("attribute_type", fields)
+            self.writer.insert("attribute_type", fields)
 
         for config_set_el in settings_el.findall("configurationSets/entry"):
-            props = ["string"]
-            fields = self.parse_props(config_set_el, props)
-            ren(fields, "string", "name")
-            cset_id = dbhelper.insert("config_set", fields, returning="_id")
+            fields = extract_config_set(config_set_el)
+            cset_id = self.writer.insert("config_set", fields, returning="_id")
             for config_e_el in config_set_el.findall("config-set/configurations/config"):
-                props = ["uuid", "name", "data"]
-                fields = self.parse_props(config_e_el, props)
+                fields = extract_config_entry(config_e_el)
                 fields["config_set"] = cset_id
-                dbhelper.insert("config_entry", fields)
+                self.writer.insert("config_entry", fields)
 
     def handle_toplevel_properties(self, el):
         for prop_el in el.findall("entry"):
@@ -381,23 +425,34 @@ class PortfolioPerformanceXML2DB:
             assert d[0][0] == "string"
             assert d[1][0] == "string"
             fields = {"name": d[0][1], "value": d[1][1]}
-            dbhelper.insert("property", fields)
+            self.writer.insert("property", fields)
 
     def handle_client(self, el):
-        props = ["version", "baseCurrency"]
-        fields = self.parse_props(el, props)
-        for n in props:
-            dbhelper.insert("property", {"name": n, "value": fields[n], "special": 1})
+        self.insert_client(extract_client(el))
+
+    def insert_client(self, fields):
+        for f in mapping.CLIENT[0]:
+            self.writer.insert("property", {"name": f.col, "value": fields[f.col], "special": 1})
 
-    def __init__(self, xml):
+    # Containers of long lists of elements, which are processed (and not
+    # looked up later) one by one, so can be deleted after processing, in
+    # low-memory mode.
+    LIST_TAGS = {
+        "prices", "events", "transactions", "securities", "accounts",
+        "portfolios", "watchlists", "taxonomies", "dashboards",
+    }
+
+    def __init__(self, xml, writer, stats=None, low_memory=False, checkpoint=None):
         self.xml = xml
+        self.writer = writer
+        self.stats = stats
+        self.low_memory = low_memory
+        # CheckpointWriter, if used
+        self.checkpoint = checkpoint
         self.refcache = {}
 
     def parse(self):
-        props = ["version", "baseCurrency"]
-        fields = self.parse_props(self.etree, props)
-        for n in props:
-            dbhelper.insert("property", {"name": n, "value": fields[n], "special": 1})
+        self.handle_client(self.etree)
 
         _log.info("Handling <security>")
         security_els = self.etree.findall("securities/security")
@@ -451,40 +506,76 @@ class PortfolioPerformanceXML2DB:
     def cur_uuid(self):
         return self.container_stack[-1][1]
 
-    def iterparse(self):
+    # Get (int) xmlid of an element, or None.
+    @staticmethod
+    def xmlid(el):
+        id = el.get("id")
+        if id is not None:
+            return int(id)
+
+    def init_state(self):
         self.el_stack = []
         self.container_stack = []
         self.cur_xmlid = None
+        # These maps have an entry per object, so may get large, and are
+        # kept compact: xmlid -> packed uuid (see compact.py).
         self.id2uuid_map = {}
+        # uuid -> container tag (interned)
         self.uuid2ctr_map = {}
         self.el_order = 0
-        for event, el in ET.iterparse(self.xml, events=("start", "end")):
+
+    # Handle end of <uuid>/<id> element.
+    def end_uuid(self, text):
+        if self.container_stack and self.container_stack[-1][1] is None:
+            self.container_stack[-1][1] = text
+            #print("Setting uuid of top container:", self.container_stack)
+            self.uuid2ctr_map[text] = self.container_stack[-1][0]
+        self.id2uuid_map[self.cur_xmlid] = pack_uuid(text)
+
+    # Parse using ImportTarget (--parser target). Parsing is interleaved
+    # with processing (target's callbacks are called from feed()), so its
+    # time is not accounted separately in stats.
+    def targetparse(self, chunk_size=1 << 20):
+        self.init_state()
+        parser = ET.XMLParser(target=ImportTarget(self), huge_tree=True)
+        while True:
+            chunk = self.xml.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+        parser.close()
+
+    def iterparse(self):
+        self.init_state()
+        events = ET.iterparse(self.xml, events=("start", "end"))
+        if self.stats is not None:
+            events = self.stats.timed_iter(events, "xml_parse")
+        checkpoint = self.checkpoint
+        for event, el in events:
             #print(event, el, el.attrib)
             self.el_order += 1
             if event == "start":
                 self.el_stack.append(el.tag)
-                if el.tag in ("security", "account", "referenceAccount", "accountFrom", "accountTo", "portfolio", "portfolioFrom", "portfolioTo"):
-                    self.cur_xmlid = el.get("id")
+                if el.tag in CONTAINER_TAGS:
+                    self.cur_xmlid = self.xmlid(el)
                     if self.cur_xmlid is not None:
                         # Real element definition, not reference
-                        self.container_stack.append([el.tag, None])
+                        self.container_stack.append([sys.intern(el.tag), None])
                         #print("Pushed on container stack:", self.container_stack)
-                elif el.tag in ("account-transaction", "accountTransaction", "portfolio-transaction", "portfolioTransaction", "transactionFrom", "transactionTo"):
-                    self.cur_xmlid = el.get("id")
+                elif el.tag in XACT_TAGS:
+                    self.cur_xmlid = self.xmlid(el)
                 elif el.tag in ("root", "classification"):
-                    self.cur_xmlid = el.get("id")
+                    self.cur_xmlid = self.xmlid(el)
                 elif el.tag in ("taxonomy", "dashboard", "settings"):
-                    self.container_stack.append([el.tag, None])
+                    self.container_stack.append([sys.intern(el.tag), None])
 
             elif event == "end":
+                if checkpoint is not None:
+                    checkpoint.next_element(self.el_order)
                 assert self.el_stack[-1] == el.tag
                 self.el_stack.pop()
                 if el.tag in ("uuid", "id"):
-                    if  self.container_stack and self.container_stack[-1][1] is None:
-                        self.container_stack[-1][1] = el.text
-                        #print("Setting uuid of top container:", self.container_stack, el.sourceline)
-                        self.uuid2ctr_map[el.text] = self.container_stack[-1][0]
-                    self.id2uuid_map[self.cur_xmlid] = el.text
+                    self.end_uuid(el.text)
 
                 elif el.tag == "price":
                     if not args.skip_prices:
@@ -503,13 +594,13 @@ class PortfolioPerformanceXML2DB:
                         self.handle_account(el, self.el_order)
                     elif el.tag == "account":
                         xmlid = el.get("reference")
-                        dbhelper.execute_dml("UPDATE account SET _order=? WHERE _xmlid=?", (self.el_order, xmlid))
+                        self.writer.set_order("account", xmlid, self.el_order)
                 elif el.tag in ("portfolio", "portfolioFrom", "portfolioTo"):
                     if el.get("id"):
                         self.handle_portfolio(el, self.el_order)
                     elif el.tag == "portfolio":
                         xmlid = el.get("reference")
-                        dbhelper.execute_dml("UPDATE account SET _order=? WHERE _xmlid=?", (self.el_order, xmlid))
+                        self.writer.set_order("account", xmlid, self.el_order)
 
                 elif el.tag == "account-transaction":
                     if el.get("id"):
@@ -517,7 +608,7 @@ class PortfolioPerformanceXML2DB:
                         self.handle_xact("account", self.cur_uuid(), el, self.el_order)
                     else:
                         xmlid = el.get("reference")
-                        dbhelper.execute_dml("UPDATE xact SET _order=? WHERE _xmlid=?", (self.el_order, xmlid))
+                        self.writer.set_order("xact", xmlid, self.el_order)
 
                 elif el.tag == "accountTransaction":
                     if el.get("id"):
@@ -532,7 +623,7 @@ class PortfolioPerformanceXML2DB:
                         self.handle_xact("portfolio", self.cur_uuid(), el, self.el_order)
                     else:
                         xmlid = el.get("reference")
-                        dbhelper.execute_dml("UPDATE xact SET _order=? WHERE _xmlid=?", (self.el_order, xmlid))
+                        self.writer.set_order("xact", xmlid, self.el_order)
 
                 elif el.tag in ("portfolioTransaction",):
                     if el.get("id"):
@@ -617,26 +708,435 @@ class PortfolioPerformanceXML2DB:
                         el.remove(ch)
                         el.text = el.tail = None
 
+                    # The (emptied) element itself still stays in the tree,
+                    # so for long lists, delete already processed preceding
+                    # siblings. (<securities> of a watchlist is processed
+                    # as a whole, so only top-level one qualifies.)
+                    if self.low_memory and self.el_stack and self.el_stack[-1] in self.LIST_TAGS \
+                            and (self.el_stack[-1] != "securities" or len(self.el_stack) == 2):
+                        parent = el.getparent()
+                        while el.getprevious() is not None:
+                            del parent[0]
+
+
+# Record being collected by ImportTarget: an open element of interest,
+# with texts of its leaf children and attributes of its children (by tag,
+# first occurrence), and other data needed to insert its row(s).
+class _Record:
+    __slots__ = ("kind", "tag", "attrib", "depth", "texts", "children", "attributes", "props", "units")
+
+    def __init__(self, kind, tag, attrib, depth):
+        self.kind = kind
+        self.tag = tag
+        self.attrib = attrib
+        self.depth = depth
+        self.texts = {}
+        self.children = {}
+        # <attributes> subtree
+        self.attributes = None
+        # Security <property>'s: [(type, name, value)]
+        self.props = []
+        # Transaction <unit>'s, as for insert_xact()
+        self.units = []
+
+
+# Element tag -> record kind
+RECORD_KINDS = {
+    "client": "client",
+    "security": "security",
+    "latest": "latest",
+    "event": "event",
+    "crossEntry": "crossEntry",
+    "unit": "unit",
+}
+RECORD_KINDS.update((tag, "account") for tag in ACCOUNT_TAGS)
+RECORD_KINDS.update((tag, "portfolio") for tag in PORTFOLIO_TAGS)
+RECORD_KINDS.update((tag, "xact") for tag in XACT_TAGS)
+
+# Small (and rare) parts with complex structure, which are built into
+# subtrees and processed by iterparse backend handlers. (Also, <attributes>
+# of records and top-level <properties>.)
+SUBTREE_TAGS = ("watchlist", "taxonomy", "dashboard", "settings")
+
+extract_client_fields = compile_field_extractor(mapping.CLIENT)
+extract_security_fields = compile_field_extractor(mapping.SECURITY)
+extract_price_fields = compile_field_extractor(mapping.PRICE)
+extract_latest_price_fields = compile_field_extractor(mapping.LATEST_PRICE)
+extract_security_event_fields = compile_field_extractor(mapping.SECURITY_EVENT)
+extract_account_fields = compile_field_extractor(mapping.ACCOUNT)
+extract_portfolio_fields = compile_field_extractor(mapping.PORTFOLIO)
+extract_xact_fields = compile_field_extractor(mapping.XACT)
+
+
+# lxml parser target for the streaming parser backend (--parser target),
+# which inserts rows directly from parser events, without building element
+# tree (so, with constant memory, besides xmlid/uuid maps). Objects of
+# interest (securities, accounts, transactions, etc.) are collected as
+# _Record's while their elements are open, and inserted when they end, at
+# the same points (and so in the same order) as with iterparse().
+class ImportTarget:
+
+    def __init__(self, conv):
+        self.conv = conv
+        self.writer = conv.writer
+        self.checkpoint = conv.checkpoint
+        # (tag, attrib) of open elements
+        self.stack = []
+        # Open records, innermost last
+        self.records = []
+        # Whether text of the current element is collected (only leaf
+        # children of records and uuids/ids are of interest)
+        self.capture = False
+        self.text = []
+        # Builder of subtree being collected, and its root depth
+        self.builder = None
+        self.builder_depth = 0
+
+    def start(self, tag, attrib):
+        conv = self.conv
+        conv.el_order += 1
+        stack = self.stack
+        stack.append((tag, attrib))
+        depth = len(stack)
+
+        if tag in CONTAINER_TAGS:
+            conv.cur_xmlid = conv.xmlid(attrib)
+            if conv.cur_xmlid is not None:
+                # Real element definition, not reference
+                conv.container_stack.append([sys.intern(tag), None])
+        elif tag in XACT_TAGS or tag == "root" or tag == "classification":
+            conv.cur_xmlid = conv.xmlid(attrib)
+        elif tag in ("taxonomy", "dashboard", "settings"):
+            conv.container_stack.append([sys.intern(tag), None])
+
+        capture = tag == "uuid" or tag == "id"
+        if self.builder is not None:
+            self.builder.start(tag, attrib)
+        else:
+            records = self.records
+            rec = records[-1] if records else None
+            if rec is not None and depth == rec.depth + 1:
+                capture = True
+                if attrib and tag not in rec.children:
+                    rec.children[tag] = attrib
+
+            if tag in SUBTREE_TAGS \
+                    or (tag == "properties" and depth == 2) \
+                    or (tag == "attributes" and capture and rec.kind in ("security", "account", "portfolio")):
+                self.builder = ET.TreeBuilder()
+                self.builder_depth = depth
+                self.builder.start(tag, attrib)
+            else:
+                kind = RECORD_KINDS.get(tag)
+                if kind is not None:
+                    if kind == "security":
+                        ok = "reference" not in attrib
+                    elif kind == "latest" or kind == "event":
+                        ok = True
+                    elif kind == "unit":
+                        ok = rec is not None and rec.kind == "xact" and depth == rec.depth + 2
+                    elif kind == "client":
+                        ok = depth == 1
+                    else:
+                        ok = bool(attrib.get("id"))
+                    if ok:
+                        records.append(_Record(kind, tag, attrib, depth))
+
+        self.capture = capture
+        if capture:
+            self.text = []
+
+    def end(self, tag):
+        conv = self.conv
+        conv.el_order += 1
+        if self.checkpoint is not None:
+            self.checkpoint.next_element(conv.el_order)
+        stack = self.stack
+        depth = len(stack)
+        attrib = stack.pop()[1]
+        leaf = self.capture
+        text = None
+        if leaf:
+            # Empty text is None, as with lxml elements.
+            text = "".join(self.text) or None
+            self.capture = False
+
+        if tag == "uuid" or tag == "id":
+            conv.end_uuid(text)
+
+        if self.builder is not None:
+            self.builder.end(tag)
+            if depth == self.builder_depth:
+                el = self.builder.close()
+                self.builder = None
+                self.end_subtree(el)
+        elif tag == "price":
+            if not args.skip_prices:
+                fields = extract_price_fields({}, attrib)
+                fields["security"] = conv.cur_uuid()
+                self.writer.insert("price", fields)
+        else:
+            records = self.records
+            rec = records[-1] if records else None
+            if rec is not None and rec.depth == depth:
+                records.pop()
+                self.end_record(rec)
+            elif rec is not None and rec.depth == depth - 1 and leaf:
+                if tag == "property" and rec.kind == "security":
+                    rec.props.append((attrib.get("type"), attrib.get("name"), text))
+                elif tag not in rec.texts:
+                    rec.texts[tag] = text
+            elif tag == "account" or tag == "portfolio":
+                # Reference
+                self.writer.set_order("account", attrib.get("reference"), conv.el_order)
+            elif tag == "account-transaction" or tag == "portfolio-transaction":
+                self.writer.set_order("xact", attrib.get("reference"), conv.el_order)
+
+        if attrib.get("reference") is None and conv.container_stack and conv.container_stack[-1][0] == tag:
+            conv.container_stack.pop()
+
+    def data(self, data):
+        if self.builder is not None:
+            self.builder.data(data)
+        if self.capture:
+            self.text.append(data)
+
+    def close(self):
+        pass
+
+    def attributes(self, rec):
+        if rec.attributes is None:
+            return ()
+        return self.conv.parse_attributes(rec.attributes, "map")
+
+    def end_record(self, rec):
+        conv = self.conv
+        kind = rec.kind
+        if kind == "xact":
+            self.end_xact(rec)
+        elif kind == "unit":
+            xact = self.records[-1]
+            xact.units.append((
+                rec.attrib.get("type"), rec.children.get("amount"), rec.children.get("forex"),
+                rec.texts.get("exchangeRate"),
+            ))
+        elif kind == "crossEntry":
+            conv.insert_cross_entry(rec.attrib.get("class"), rec.children.get)
+        elif kind == "latest":
+            fields = extract_latest_price_fields(rec.texts, rec.attrib)
+            fields["security"] = conv.cur_uuid()
+            self.writer.insert("latest_price", fields)
+        elif kind == "event":
+            fields = extract_security_event_fields(rec.texts, rec.attrib)
+            fields["security"] = conv.cur_uuid()
+            self.writer.insert("security_event", fields)
+        elif kind == "security":
+            fields = extract_security_fields(rec.texts, rec.attrib)
+            conv.insert_security(fields, self.attributes(rec), rec.props)
+        elif kind == "account":
+            fields = extract_account_fields(rec.texts, rec.attrib)
+            conv.insert_account(fields, "account", conv.el_order, self.attributes(rec))
+        elif kind == "portfolio":
+            fields = extract_portfolio_fields(rec.texts, rec.attrib)
+            fields["referenceAccount"] = conv.uuid(rec.children.get("referenceAccount"))
+            conv.insert_account(fields, "portfolio", conv.el_order, self.attributes(rec))
+        elif kind == "client":
+            conv.insert_client(extract_client_fields(rec.texts, rec.attrib))
+
+    def end_xact(self, rec):
+        conv = self.conv
+        tag = rec.tag
+        orderno = 0
+        if tag == "account-transaction":
+            acc_type = "account"
+            uuid = conv.cur_uuid()
+            orderno = conv.el_order
+        elif tag == "portfolio-transaction":
+            acc_type = "portfolio"
+            uuid = conv.cur_uuid()
+            orderno = conv.el_order
+        else:
+            # Transaction of crossEntry, its account is a sibling element.
+            parent = self.records[-1]
+            assert parent.kind == "crossEntry" and parent.depth == rec.depth - 1, parent.tag
+            if tag == "accountTransaction":
+                acc_type = acc_tag = "account"
+            elif tag == "portfolioTransaction":
+                acc_type = acc_tag = "portfolio"
+            else:
+                cls = parent.attrib.get("class")
+                if cls == "account-transfer":
+                    acc_type = "account"
+                elif cls == "portfolio-transfer":
+                    acc_type = "portfolio"
+                else:
+                    assert False, "Unexpected crossEntry class: " + cls
+                acc_tag = acc_type + ("To" if tag == "transactionTo" else "From")
+            uuid = conv.uuid(parent.children.get(acc_tag))
+
+        if acc_type == "account":
+            assert conv.is_account_tag(conv.uuid2ctr_map[uuid]), conv.uuid2ctr_map[uuid]
+        else:
+            assert conv.uuid2ctr_map[uuid].startswith("portfolio"), conv.uuid2ctr_map[uuid]
+        fields = extract_xact_fields(rec.texts, rec.attrib)
+        conv.insert_xact(acc_type, uuid, fields, rec.children.get("security"), rec.units, orderno)
+
+    def end_subtree(self, el):
+        conv = self.conv
+        tag = el.tag
+        if tag == "attributes":
+            self.records[-1].attributes = el
+        elif tag == "watchlist":
+            conv.handle_watchlist(el, conv.el_order)
+        elif tag == "taxonomy":
+            conv.handle_taxonomy(el)
+        elif tag == "dashboard":
+            conv.handle_dashboard(el)
+        elif tag == "settings":
+            conv.handle_settings(el)
+        elif tag == "properties":
+            conv.handle_toplevel_properties(el)
+
 
 if __name__ == "__main__":
     argp = argparse.ArgumentParser(description="Import PortfolioPerformance XML file to Sqlite DB")
-    argp.add_argument("xml_file", help="input XML file")
+    argp.add_argument("xml_file", help="input XML file (may be compressed: gzip, xz, bz2, zstd, or ZIP as saved by PP)")
     argp.add_argument("db", help="output DB (filename/connect string)")
     argp.add_argument("--dbtype", choices=("sqlite", "pgsql"), default="sqlite", help="select database type")
     argp.add_argument("--debug", action="store_true", help="enable debug logging")
     argp.add_argument("--dry-run", action="store_true", help="don't commit changes to DB")
     argp.add_argument("--skip-prices", action="store_true", help="don't import historical prices (95+%% of DB size and import time; useful for debugging)")
+    argp.add_argument("--incremental", action="store_true", help="update existing database with changes only, instead of inserting all data into empty one")
+    argp.add_argument("--prices-only", action="store_true", help="quickly sync only historical/latest prices of securities already in existing database (other data in the file is skipped, without even being parsed into a tree)")
+    argp.add_argument("--batch-size", type=int, default=1000, help="insert rows in batches of this size (0 - insert one by one, default: %(default)s). For pgsql, high-volume tables are loaded using COPY in such batches")
+    argp.add_argument("--writer-thread", action="store_true", help="write to DB in a separate thread, in parallel with parsing XML")
+    argp.add_argument("--queue-size", type=int, default=64, help="max number of batches queued for the writer thread (default: %(default)s)")
+    argp.add_argument("--fast", action="store_true", help="bulk load profile: create secondary indexes only after loading data, and for sqlite, trade durability during the load for speed")
+    argp.add_argument("--in-memory", action="store_true", help="(sqlite) load database into memory, import there and then replace database file with the result atomically (readers never see partially imported data)")
+    argp.add_argument("--shadow", action="store_true", help="import into a shadow database (sqlite: sibling file, pgsql: separate schema), then swap it in place of the database atomically, so its readers are not disturbed by the import")
+    argp.add_argument("--checkpoint-every", type=int, metavar="N", help="commit after every (about) N rows, recording progress, so an interrupted import can be continued with --resume")
+    argp.add_argument("--resume", action="store_true", help="continue interrupted import done with --checkpoint-every (with the same file and options)")
+    argp.add_argument("--parser", choices=("iterparse", "target"), help="XML parser backend: iterparse - processes (pruned) element tree, target - inserts rows directly from parser events, without building element tree (faster, constant memory). Default: iterparse")
+    argp.add_argument("--low-memory", action="store_true", help="delete processed elements from the parsed tree as soon as possible, to keep memory usage flat on large files (see peak RSS reported by --stats)")
+    argp.add_argument("--stats", action="store_true", help="print statistics (rows per table, time per phase, peak memory) to stderr at the end")
+    argp.add_argument("--stats-json", action="store_true", help="print statistics as JSON (implies --stats)")
     argp.add_argument("--version", action="version", version="%(prog)s " + __version__)
     args = argp.parse_args()
+    if args.fast and args.incremental:
+        argp.error("--fast is for loading into empty database, can't be used with --incremental")
+    if args.prices_only and (args.fast or args.incremental or args.skip_prices):
+        argp.error("--prices-only can't be used with --fast, --incremental or --skip-prices")
+    if args.prices_only and (args.parser is not None or args.low_memory or args.writer_thread):
+        argp.error("--prices-only has its own parser and writer, can't be used with --parser, --low-memory or --writer-thread")
+    if args.low_memory and args.parser == "target":
+        argp.error("--low-memory applies only to --parser iterparse (--parser target always uses constant memory)")
+    if args.in_memory and args.dbtype != "sqlite":
+        argp.error("--in-memory is supported only for sqlite")
+    if args.in_memory and args.shadow:
+        argp.error("--in-memory and --shadow can't be used together")
+    if args.resume and not args.checkpoint_every:
+        argp.error("--resume requires --checkpoint-every")
+    if args.checkpoint_every and (args.incremental or args.prices_only or args.writer_thread or args.in_memory or args.shadow or args.dry_run):
+        argp.error("--checkpoint-every can't be used with --incremental, --prices-only, --writer-thread, --in-memory, --shadow or --dry-run")
 
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
 
-    dbhelper.init(args.dbtype, args.db)
-
-    with open(args.xml_file, "rb") as f:
-        conv = PortfolioPerformanceXML2DB(f)
-        conv.iterparse()
-
-    if not args.dry_run:
-        dbhelper.commit()
+    stats = None
+    if args.stats or args.stats_json:
+        stats = dbhelper.stats = Stats()
+
+    if args.shadow:
+        # Full import starts with empty tables, others work on a copy of
+        # the data.
+        ppxml2db_init.init_shadow(args.dbtype, args.db, copy=args.incremental or args.prices_only)
+    else:
+        dbhelper.init(args.dbtype, args.db, in_memory=args.in_memory)
+    dbhelper.batch_size = args.batch_size
+    # High-volume tables
+    dbhelper.copy_tables = {"price", "xact", "xact_unit", "security_event", "security_attr"}
+
+    if args.prices_only:
+        sync = PriceSync(stats)
+        with fileio.open_input(args.xml_file) as f:
+            sync.sync(f)
+        sync.report(sys.stdout)
+        if not args.dry_run:
+            dbhelper.commit()
+            if args.in_memory:
+                dbhelper.publish(args.db)
+            elif args.shadow:
+                ppxml2db_init.swap_shadow(args.db)
+        else:
+            dbhelper.rollback()
+            if args.shadow:
+                ppxml2db_init.drop_shadow(args.db)
+        if stats is not None:
+            stats.report(sys.stderr, "json" if args.stats_json else "text", "processing")
+        sys.exit()
+
+    if args.fast:
+        if args.dbtype == "sqlite":
+            saved_pragmas = dbhelper.set_pragmas(dbhelper.SQLITE_FAST_PRAGMAS)
+        # It's faster to build indexes once, than to update them per row.
+        # They are dropped in the load transaction, so come back if it's
+        # rolled back.
+        dbhelper.begin()
+        ppxml2db_init.drop_indexes()
+
+    pipeline = None
+    try:
+        if args.incremental:
+            writer = IncrementalWriter(keep_tables=["price"] if args.skip_prices else [])
+        else:
+            writer = DBWriter()
+        pipeline = writer
+        checkpoint = None
+        if args.checkpoint_every:
+            st = os.stat(args.xml_file)
+            fingerprint = "%s:%d:%d" % (os.path.basename(args.xml_file), st.st_size, st.st_mtime)
+            pipeline = checkpoint = CheckpointWriter(writer, args.checkpoint_every, fingerprint, args.resume)
+        if args.writer_thread:
+            pipeline = ThreadedWriter(writer, args.queue_size, args.batch_size)
+
+        with fileio.open_input(args.xml_file) as f:
+            conv = PortfolioPerformanceXML2DB(f, pipeline, stats, args.low_memory, checkpoint)
+            if args.parser == "target":
+                conv.targetparse()
+            else:
+                conv.iterparse()
+        pipeline.finish()
+
+        if args.incremental:
+            writer.report(sys.stdout)
+
+        if args.fast:
+            ppxml2db_init.create_indexes()
+
+        if not args.dry_run:
+            dbhelper.commit()
+        else:
+            dbhelper.rollback()
+    except BaseException:
+        if isinstance(pipeline, ThreadedWriter):
+            pipeline.abort()
+        dbhelper.rollback()
+        if args.fast:
+            # Checkpoints (--checkpoint-every) may have committed the drop.
+            ppxml2db_init.create_indexes()
+            dbhelper.commit()
+        raise
+    finally:
+        if args.fast and args.dbtype == "sqlite":
+            dbhelper.set_pragmas(saved_pragmas)
+
+    if args.in_memory and not args.dry_run:
+        dbhelper.publish(args.db)
+    if args.shadow:
+        if args.dry_run:
+            ppxml2db_init.drop_shadow(args.db)
+        else:
+            ppxml2db_init.swap_shadow(args.db)
+
+    if stats is not None:
+        stats.report(sys.stderr, "json" if args.stats_json else "text", "processing")
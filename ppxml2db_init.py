@@ -1,4 +1,7 @@
 import sys
+import os
+import re
+import sqlite3
 import argparse
 import logging
 
@@ -31,27 +34,176 @@ SCHEMA = [
     "attribute_type",
     "config_set",
     "config_entry",
+    "import_progress",
 ]
 
 
+# Name of pgsql schema to import data into with ppxml2db.py --shadow, from
+# which its tables are moved to the live schema when swapping them in.
+SHADOW_SCHEMA = "ppxml2db_shadow"
+
+
+# Indexes which were in the schema of older versions, but are superseded
+# by other ones (and so are only overhead on inserts).
+OBSOLETE_INDEXES = [
+    # By xact__account_order
+    "xact__account",
+]
+
+
+INDEX_RE = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+(\w+)\s[^;]*;\s*", re.I)
+
+
 _log = logging.getLogger(__name__)
 
 
+def read_schema(table):
+    with open(table + ".sql") as f:
+        return f.read()
+
+
+# Split table schema into table creation part and list of (index name,
+# CREATE INDEX statement) for its secondary indexes.
+def split_indexes(sql):
+    indexes = [(m.group(1), m.group(0).strip()) for m in INDEX_RE.finditer(sql)]
+    return INDEX_RE.sub("", sql), indexes
+
+
+def schema_indexes():
+    indexes = []
+    for table in SCHEMA:
+        indexes.extend(split_indexes(read_schema(table))[1])
+    return indexes
+
+
+# Drop secondary indexes (obsolete ones too, which are then not created
+# again by create_indexes()).
+def drop_indexes():
+    for name, _ in schema_indexes():
+        dbhelper.execute_dml("DROP INDEX IF EXISTS %s" % name)
+    drop_obsolete_indexes()
+
+
+def drop_obsolete_indexes():
+    for name in OBSOLETE_INDEXES:
+        dbhelper.execute_dml("DROP INDEX IF EXISTS %s" % name)
+
+
+# Create secondary indexes (which don't exist yet). Statements are
+# executed one by one (not with executescript(), which commits the current
+# transaction for sqlite), so this can be rolled back with the data.
+def create_indexes():
+    for name, sql in schema_indexes():
+        _log.info("Creating index %s", name)
+        sql = re.sub(r"INDEX\s+", "INDEX IF NOT EXISTS ", sql, count=1, flags=re.I)
+        dbhelper.execute_dml(sql.rstrip(";"))
+
+
+# Shapes of queries which the exporter and importer issue per row (so
+# should be index lookups), as (SQL, tables it's ok to scan). Queries over
+# whole tables are not included, except when joining other tables.
+QUERY_SHAPES = [
+    # db2ppxml.py
+    ("SELECT * FROM property WHERE name=?", ()),
+    ("SELECT * FROM security WHERE _id BETWEEN ? AND ? ORDER BY _id", ()),
+    ("SELECT security._id, price.tstamp, price.value FROM security"
+     " JOIN price ON price.security = security.uuid"
+     " ORDER BY security._id, price.tstamp", ("security",)),
+    ("SELECT * FROM latest_price WHERE security=?", ()),
+    ("SELECT * FROM security_attr WHERE security=? ORDER BY seq", ()),
+    ("SELECT * FROM security_event WHERE security=?", ()),
+    ("SELECT * FROM security_event WHERE security=? ORDER BY date, details", ()),
+    ("SELECT * FROM security_prop WHERE security=? ORDER BY seq", ()),
+    ("SELECT * FROM watchlist_security WHERE list=?", ()),
+    ("SELECT * FROM account WHERE uuid=?", ()),
+    ("SELECT * FROM account_attr WHERE account=? ORDER BY seq", ()),
+    ("SELECT * FROM xact WHERE account=? ORDER BY _order", ()),
+    ("SELECT * FROM xact WHERE uuid=?", ()),
+    ("SELECT * FROM xact_unit WHERE xact=?", ()),
+    ("SELECT * FROM xact_cross_entry WHERE from_xact=? OR to_xact=?", ()),
+    ("SELECT * FROM taxonomy_category WHERE uuid=?", ()),
+    ("SELECT * FROM taxonomy_category WHERE parent=?", ()),
+    ("SELECT * FROM taxonomy_assignment WHERE category=?", ()),
+    ("SELECT * FROM taxonomy_assignment_data WHERE assignment=?", ()),
+    ("SELECT * FROM taxonomy_data WHERE category=?", ()),
+    ("SELECT * FROM taxonomy_data WHERE taxonomy=? AND category IS NULL AND name='dimension'", ()),
+    ("SELECT * FROM config_entry WHERE config_set=?", ()),
+    # ppxml2db.py
+    ("UPDATE account SET _order=? WHERE uuid=?", ()),
+    ("UPDATE xact SET _order=? WHERE uuid=?", ()),
+    # ppxml2db.py --incremental
+    ("SELECT tstamp, value FROM price WHERE security=?", ()),
+    ("UPDATE price SET value=? WHERE security=? AND tstamp=?", ()),
+    ("DELETE FROM price WHERE security=? AND tstamp=?", ()),
+    ("DELETE FROM price WHERE security=?", ()),
+    ("DELETE FROM security_attr WHERE security=?", ()),
+    ("DELETE FROM security_prop WHERE security=?", ()),
+    ("DELETE FROM security_event WHERE security=?", ()),
+    ("DELETE FROM account_attr WHERE account=?", ()),
+    ("DELETE FROM xact_unit WHERE xact=?", ()),
+    ("DELETE FROM taxonomy_data WHERE taxonomy=?", ()),
+]
+
+
+# Return list of (flagged, plan line) for a query.
+def query_plan(sql, ok_scans):
+    res = []
+    cursor = dbhelper.db.cursor()
+    params = ("0",) * sql.count("?")
+    if dbhelper.dbtype == "pgsql":
+        cursor.execute("EXPLAIN " + sql.replace("?", "%s"), params)
+        for r in cursor.fetchall():
+            line = r[0]
+            m = re.search(r"Seq Scan on (\w+)", line)
+            res.append((m is not None and m.group(1) not in ok_scans, line))
+    else:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        for r in cursor.fetchall():
+            line = r[3]
+            m = re.match(r"SCAN (?:TABLE )?(\w+)", line)
+            res.append((m is not None and m.group(1) not in ok_scans, line))
+    return res
+
+
+# Print query plans of QUERY_SHAPES, flagging full table scans. Returns
+# number of flagged queries.
+def check_indexes(f=sys.stdout):
+    if dbhelper.dbtype == "pgsql":
+        # Otherwise, pgsql may prefer sequential scans of small tables even
+        # if there's an index.
+        dbhelper.execute_dml("SET enable_seqscan = off")
+    flagged = 0
+    for sql, ok_scans in QUERY_SHAPES:
+        plan = query_plan(sql, ok_scans)
+        bad = any(b for b, _ in plan)
+        flagged += bad
+        print("%s %s" % ("SCAN" if bad else "ok  ", sql), file=f)
+        for b, line in plan:
+            print("       %s%s" % ("!! " if b else "", line), file=f)
+    return flagged
+
+
 def drop_table(table):
     sql = "DROP TABLE IF EXISTS %s" % table
-    if args.dbtype == "pgsql":
+    if dbhelper.dbtype == "pgsql":
         sql += " CASCADE"
     dbhelper.execute_dml(sql)
 
 
-def main(args):
+# If missing_only is True, only tables which don't exist yet are created.
+def create_tables(recreate=False, fast=False, missing_only=False):
     for table in SCHEMA:
-        with open(table + ".sql") as f:
-            sql = f.read()
-        if args.recreate:
+        if missing_only and dbhelper.table_columns(table):
+            continue
+        sql = read_schema(table)
+        if recreate:
             drop_table(table)
 
-        if args.dbtype == "pgsql":
+        if fast:
+            # Indexes are created after loading data (ppxml2db.py --fast).
+            sql, _ = split_indexes(sql)
+
+        if dbhelper.dbtype == "pgsql":
             sql = sql.replace(
                 "INTEGER NOT NULL PRIMARY KEY",
                 "SERIAL NOT NULL PRIMARY KEY"
@@ -60,11 +212,141 @@ def main(args):
         dbhelper.executescript(sql)
 
 
+# Shadow database is a copy of the database which is filled while readers
+# keep using the original one undisturbed, then swapped in atomically by
+# swap_shadow(). For sqlite, it's a sibling file, for pgsql, a separate
+# schema in the same database.
+def shadow_name(dbname):
+    return dbname + ".shadow"
+
+
+# Connect to (new) shadow database, with empty tables, or (if copy is
+# True) a copy of the database data.
+def init_shadow(dbtype, dbname, copy=False):
+    if dbtype == "pgsql":
+        dbhelper.init(dbtype, dbname)
+        live = dbhelper.query("SELECT current_schema()")[0][0]
+        # Left by a failed run
+        dbhelper.execute_dml("DROP SCHEMA IF EXISTS %s CASCADE" % SHADOW_SCHEMA)
+        dbhelper.execute_dml("CREATE SCHEMA %s" % SHADOW_SCHEMA)
+        dbhelper.execute_dml("SET search_path TO %s" % SHADOW_SCHEMA)
+        create_tables()
+        if copy:
+            for table in SCHEMA:
+                cols = [c for c, _ in dbhelper.table_columns(table)]
+                col_list = ", ".join(cols)
+                dbhelper.execute_dml("INSERT INTO %s (%s) SELECT %s FROM %s.%s" % (table, col_list, col_list, live, table))
+                if "_id" in cols:
+                    dbhelper.execute_dml(
+                        "SELECT setval(pg_get_serial_sequence('%s', '_id'), COALESCE(MAX(_id), 0) + 1, false) FROM %s"
+                        % (table, table)
+                    )
+        return
+
+    shadow = shadow_name(dbname)
+    if os.path.exists(shadow):
+        os.remove(shadow)
+    if copy:
+        src = sqlite3.connect(dbname)
+        dst = sqlite3.connect(shadow)
+        src.backup(dst)
+        dst.close()
+        src.close()
+    dbhelper.init(dbtype, shadow)
+    if not copy:
+        create_tables()
+
+
+# GRANT statements giving other roles the privileges they have on the
+# given pgsql relation (if it exists), to carry them over to a replacement
+# of the same name. kind is TABLE or SEQUENCE.
+def relation_grants(relation, kind):
+    rows = dbhelper.query(
+        "SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END,"
+        " a.privilege_type, a.is_grantable"
+        " FROM pg_class c, aclexplode(c.relacl) a"
+        " WHERE c.oid = to_regclass(?) AND a.grantee <> c.relowner",
+        (relation,)
+    )
+    return [
+        "GRANT %s ON %s %s TO %s%s" % (priv, kind, relation, grantee, " WITH GRANT OPTION" if grantable else "")
+        for grantee, priv, grantable in rows
+    ]
+
+
+# Replace the database with the (committed) shadow one.
+def swap_shadow(dbname):
+    if dbhelper.dbtype == "pgsql":
+        # As shadow schema is the only one in search_path, current_schema()
+        # can't be used to get the name of the live one.
+        dbhelper.execute_dml("RESET search_path")
+        live = dbhelper.query("SELECT current_schema()")[0][0]
+        _log.info("Moving tables from schema %s to %s", SHADOW_SCHEMA, live)
+        # Only our tables are replaced, in one transaction, so readers see
+        # either all old or all new ones. Other objects in the live schema,
+        # and the schema itself, are left alone. A view using the tables
+        # prevents dropping them (and so fails the swap).
+        grants = []
+        for table in SCHEMA:
+            grants += relation_grants("%s.%s" % (live, table), "TABLE")
+            grants += relation_grants("%s.%s__id_seq" % (live, table), "SEQUENCE")
+        # All at once, as they reference each other.
+        dbhelper.execute_dml("DROP TABLE IF EXISTS %s" % ", ".join("%s.%s" % (live, t) for t in SCHEMA))
+        for table in SCHEMA:
+            # Its _id sequence and indexes move along.
+            dbhelper.execute_dml("ALTER TABLE %s.%s SET SCHEMA %s" % (SHADOW_SCHEMA, table, live))
+        for sql in grants:
+            dbhelper.execute_dml(sql)
+        dbhelper.execute_dml("DROP SCHEMA %s" % SHADOW_SCHEMA)
+        dbhelper.commit()
+        return
+
+    # Don't leave the database in WAL mode, as readers of the old file
+    # would share the -wal file with the new one.
+    dbhelper.db.execute("PRAGMA journal_mode = DELETE")
+    dbhelper.db.close()
+    # Nor leave the -wal file of the old one to be applied to the new one.
+    dbhelper.release_wal(dbname)
+    _log.info("Renaming %s to %s", shadow_name(dbname), dbname)
+    os.replace(shadow_name(dbname), dbname)
+
+
+# Discard shadow database (e.g. on a dry run).
+def drop_shadow(dbname):
+    if dbhelper.dbtype == "pgsql":
+        # Was created in the same (rolled back) transaction.
+        return
+    dbhelper.db.close()
+    os.remove(shadow_name(dbname))
+
+
+def main(args):
+    if args.check_indexes:
+        flagged = check_indexes()
+        if flagged:
+            print("%d queries do full table scans, use --upgrade to add missing indexes" % flagged)
+            sys.exit(1)
+        return
+
+    if args.upgrade:
+        # Add tables and indexes which may be missing in database created
+        # by older version, and drop ones no longer used.
+        create_tables(missing_only=True)
+        create_indexes()
+        drop_obsolete_indexes()
+        return
+
+    create_tables(args.recreate, args.fast)
+
+
 if __name__ == "__main__":
     argp = argparse.ArgumentParser(description="Initialize database for ppxml2db")
     argp.add_argument("db", help="output DB (filename/connect string)")
     argp.add_argument("--dbtype", choices=("sqlite", "pgsql"), default="sqlite", help="select database type")
     argp.add_argument("--recreate", action="store_true", help="delete existing tables")
+    argp.add_argument("--fast", action="store_true", help="don't create secondary indexes (to be created by ppxml2db.py --fast after loading data)")
+    argp.add_argument("--check-indexes", action="store_true", help="show query plans for queries issued by import/export, exit with error if some do full table scans")
+    argp.add_argument("--upgrade", action="store_true", help="upgrade existing database, adding missing tables and indexes, and dropping obsolete indexes")
     argp.add_argument("--debug", action="store_true", help="enable debug logging")
     argp.add_argument("--dry-run", action="store_true", help="don't commit changes to DB")
     argp.add_argument("--version", action="version", version="%(prog)s " + __version__)
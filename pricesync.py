@@ -0,0 +1,188 @@
+import logging
+import time
+
+import lxml.etree as ET
+
+import dbhelper
+
+
+_log = logging.getLogger(__name__)
+
+
+# Upsert statements per table.
+UPSERT_SQL = {
+    "price": (
+        "INSERT INTO price(security, tstamp, value) VALUES (?, ?, ?)"
+        " ON CONFLICT(security, tstamp) DO UPDATE SET value=excluded.value"
+    ),
+    "latest_price": (
+        "INSERT INTO latest_price(security, tstamp, value, high, low, volume) VALUES (?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT(security) DO UPDATE SET tstamp=excluded.tstamp, value=excluded.value,"
+        " high=excluded.high, low=excluded.low, volume=excluded.volume"
+    ),
+}
+
+LATEST_CHILDREN = ("high", "low", "volume")
+
+
+# lxml parser target, which picks <price>'s and <latest> of top-level
+# securities (client/securities/security) and ignores everything else.
+# No element tree is built at all, and callbacks are kept trivial for
+# the uninteresting elements (the vast majority of them).
+class PriceTarget:
+
+    def __init__(self):
+        self.depth = 0
+        # Inside client/securities
+        self.in_securities = False
+        self.sec_uuid = None
+        # Name of the element which text is being collected, if any
+        self.capture = None
+        self.text = []
+        self.latest = None
+        self.latest_row = None
+        self.prices = []
+        # Parsed securities: (uuid, prices, latest price or None)
+        self.securities = []
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        depth = self.depth
+        if depth == 5:
+            if tag == "price" and self.sec_uuid is not None:
+                self.prices.append((attrib["t"], attrib["v"]))
+            elif self.latest is not None and tag in LATEST_CHILDREN:
+                self.capture = tag
+        elif depth == 4:
+            if self.sec_uuid is None:
+                return
+            if tag == "uuid":
+                self.capture = tag
+            elif tag == "latest":
+                self.latest = {"t": attrib.get("t"), "v": attrib.get("v")}
+            elif tag == "prices" and self.sec_uuid == "":
+                raise ValueError("<prices> before <uuid> in <security>")
+        elif depth == 3:
+            # Securities with reference attribute don't have own data.
+            if self.in_securities and tag == "security" and "reference" not in attrib:
+                self.sec_uuid = ""
+        elif depth == 2:
+            self.in_securities = tag == "securities"
+
+    def end(self, tag):
+        if self.capture is not None:
+            text = "".join(self.text)
+            self.text = []
+            if self.capture == "uuid":
+                self.sec_uuid = text
+            else:
+                self.latest[self.capture] = text
+            self.capture = None
+        elif self.depth == 4 and tag == "latest" and self.latest is not None:
+            latest = self.latest
+            self.latest_row = (
+                latest["t"], latest["v"], latest.get("high"), latest.get("low"), latest.get("volume"),
+            )
+            self.latest = None
+        elif self.depth == 3 and self.sec_uuid is not None:
+            self.securities.append((self.sec_uuid, self.prices, self.latest_row))
+            self.sec_uuid = None
+            self.prices = []
+            self.latest_row = None
+        self.depth -= 1
+
+    def data(self, data):
+        if self.capture is not None:
+            self.text.append(data)
+
+    def close(self):
+        pass
+
+
+# Sync historical and latest prices of securities from XML file into an
+# existing database, without touching anything else. Prices of each
+# security are compared with ones in the DB (fetched by a range scan of
+# the (security, tstamp) index), and only new/changed ones are upserted.
+# Prices which are no longer in the file are not deleted (use
+# --incremental import for a full sync).
+class PriceSync:
+
+    def __init__(self, stats=None, chunk_size=1 << 20):
+        self.stats = stats
+        self.chunk_size = chunk_size
+        self.sec_uuids = {r[0] for r in dbhelper.query("SELECT uuid FROM security")}
+        # table -> [rows in file, rows written]
+        self.counts = {table: [0, 0] for table in UPSERT_SQL}
+        # Securities not in the DB
+        self.skipped = 0
+
+    @staticmethod
+    def as_str(v):
+        return None if v is None else str(v)
+
+    def write(self, securities):
+        if not securities:
+            return
+        prices = []
+        latest_prices = []
+        as_str = self.as_str
+        for uuid, sec_prices, latest in securities:
+            if uuid not in self.sec_uuids:
+                self.skipped += 1
+                continue
+            if sec_prices:
+                self.counts["price"][0] += len(sec_prices)
+                if self.stats is not None:
+                    self.stats.count("price", len(sec_prices))
+                existing = {
+                    r[0]: str(r[1])
+                    for r in dbhelper.query("SELECT tstamp, value FROM price WHERE security=?", (uuid,))
+                }
+                for t, v in sec_prices:
+                    if existing.get(t) != v:
+                        prices.append((uuid, t, v))
+            if latest is not None:
+                self.counts["latest_price"][0] += 1
+                if self.stats is not None:
+                    self.stats.count("latest_price")
+                rows = dbhelper.query(
+                    "SELECT tstamp, value, high, low, volume FROM latest_price WHERE security=?", (uuid,)
+                )
+                if not rows or tuple(as_str(v) for v in rows[0]) != latest:
+                    latest_prices.append((uuid,) + latest)
+        securities.clear()
+
+        for table, rows in (("price", prices), ("latest_price", latest_prices)):
+            if rows:
+                dbhelper.executemany_dml(UPSERT_SQL[table], rows, cached=True)
+                self.counts[table][1] += len(rows)
+
+    def sync(self, f):
+        target = PriceTarget()
+        parser = ET.XMLParser(target=target, huge_tree=True)
+        while True:
+            t = time.perf_counter()
+            chunk = f.read(self.chunk_size)
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+            if self.stats is not None:
+                self.stats.add_time("xml_parse", time.perf_counter() - t)
+            self.write(target.securities)
+            if not chunk:
+                break
+        if self.skipped:
+            _log.warning(
+                "Prices of %d securities not in the database skipped, run full (or --incremental) import to add them",
+                self.skipped
+            )
+
+    def report(self, f):
+        for table in sorted(self.counts):
+            total, written = self.counts[table]
+            print("%-24s synced: %d, written: %d, unchanged: %d" % (
+                table, total, written, total - written
+            ), file=f)
+        if self.skipped:
+            print("%-24s %d (not in database)" % ("skipped securities", self.skipped), file=f)
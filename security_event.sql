@@ -5,3 +5,5 @@ date VARCHAR(36) NOT NULL,
 type VARCHAR(32) NOT NULL,
 details TEXT
 );
+
+CREATE INDEX security_event__security ON security_event(security);
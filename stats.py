@@ -0,0 +1,97 @@
+import sys
+import time
+import json
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+# Collects statistics of a run: number of rows per table and time spent
+# in different phases (parsing/writing XML, DB execution). Meant to be
+# cheap enough to be used on production runs. The time not accounted to
+# any phase is reported under the name passed to report().
+class Stats:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.rows = defaultdict(int)
+        self.times = defaultdict(float)
+
+    def count(self, table, n=1):
+        self.rows[table] += n
+
+    def add_time(self, phase, secs):
+        self.times[phase] += secs
+
+    # Add statistics collected elsewhere (e.g. by a worker process).
+    def merge(self, rows, times):
+        for table, n in rows.items():
+            self.rows[table] += n
+        for phase, secs in times.items():
+            self.times[phase] += secs
+
+    # Wrap an iterator, accounting time spent in producing its items to
+    # the given phase.
+    def timed_iter(self, it, phase):
+        it = iter(it)
+        perf_counter = time.perf_counter
+        times = self.times
+        while True:
+            t = perf_counter()
+            try:
+                v = next(it)
+            except StopIteration:
+                times[phase] += perf_counter() - t
+                return
+            times[phase] += perf_counter() - t
+            yield v
+
+    # Peak resident set size of the process, in KiB (None if unknown).
+    @staticmethod
+    def peak_rss():
+        if resource is None:
+            return None
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports it in bytes, others in KiB
+        if sys.platform == "darwin":
+            rss //= 1024
+        return rss
+
+    def as_dict(self, other_phase="other"):
+        total = time.perf_counter() - self.start
+        times = dict(self.times)
+        # Phases may overlap if they run in different threads, then this
+        # is 0.
+        times[other_phase] = max(0.0, total - sum(self.times.values()))
+        total_rows = sum(self.rows.values())
+        return {
+            "total_time": round(total, 3),
+            "times": {k: round(v, 3) for k, v in times.items()},
+            "rows": dict(sorted(self.rows.items())),
+            "total_rows": total_rows,
+            "rows_per_sec": round(total_rows / total) if total else 0,
+            "peak_rss_kb": self.peak_rss(),
+        }
+
+    def report(self, f, fmt="text", other_phase="other"):
+        d = self.as_dict(other_phase)
+        if fmt == "json":
+            json.dump(d, f, indent=2)
+            f.write("\n")
+            return
+
+        print("Rows per table:", file=f)
+        for table, cnt in d["rows"].items():
+            print("  %-25s %10d" % (table, cnt), file=f)
+        print("  %-25s %10d" % ("total", d["total_rows"]), file=f)
+        print("Time (s):", file=f)
+        for phase, secs in d["times"].items():
+            print("  %-25s %10.3f" % (phase, secs), file=f)
+        print("  %-25s %10.3f" % ("total", d["total_time"]), file=f)
+        print("Throughput: %d rows/s" % d["rows_per_sec"], file=f)
+        if d["peak_rss_kb"] is not None:
+            print("Peak RSS: %.1f MiB" % (d["peak_rss_kb"] / 1024), file=f)
@@ -12,3 +12,4 @@ weight INT NOT NULL DEFAULT 10000,
 rank INT NOT NULL DEFAULT 0
 );
 CREATE INDEX taxonomy_assignment__item_type_item ON taxonomy_assignment(item_type, item);
+CREATE INDEX taxonomy_assignment__category ON taxonomy_assignment(category);
@@ -4,3 +4,5 @@ name VARCHAR(64) NOT NULL,
 type VARCHAR(64) NOT NULL,
 value VARCHAR(256) NOT NULL
 );
+
+CREATE INDEX taxonomy_assignment_data__assignment ON taxonomy_assignment_data(assignment);
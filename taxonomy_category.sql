@@ -10,3 +10,4 @@ rank INT NOT NULL
 );
 
 CREATE UNIQUE INDEX taxonomy_category__uuid ON taxonomy_category(uuid);
+CREATE INDEX taxonomy_category__parent ON taxonomy_category(parent);
@@ -19,4 +19,4 @@ _order INT NOT NULL
 );
 
 CREATE UNIQUE INDEX xact__uuid ON xact(uuid);
-CREATE INDEX xact__account ON xact(account);
+CREATE INDEX xact__account_order ON xact(account, _order);